@@ -1,22 +1,26 @@
 # agent_workflow.py
 from __future__ import annotations
 
+import importlib
+import time
 from types import SimpleNamespace
 from typing import Any, Optional
 
 from agents import (
     function_tool,
-    Agent,
-    ModelSettings,
     TResponseInputItem,
     Runner,
-    RunConfig,
     trace,
+    set_default_openai_client,
 )
-from openai import AsyncOpenAI
 from guardrails.runtime import load_config_bundle, instantiate_guardrails, run_guardrails
+from openai._models import construct_type
+from openai.types.chat import ChatCompletion
+from openai.types.responses import Response
 from pydantic import BaseModel
 
+from http_transport import get_openai_client, on_openai_client
+
 
 # ----------------------------
 # Tool definitions
@@ -39,20 +43,83 @@ def get_retention_offers(
 
 
 # ----------------------------
-# Shared client for guardrails
+# Shared client for agents + guardrails
 # ----------------------------
-client = AsyncOpenAI()
-ctx = SimpleNamespace(guardrail_llm=client)
+# The agents default is set whenever http_transport builds a client, not per request
+on_openai_client(set_default_openai_client)
+get_openai_client()
+
+
+def guardrail_ctx():
+    return SimpleNamespace(guardrail_llm=get_openai_client())
+
+
+# Smallest replies the SDK accepts; parsing them builds its cached validators
+_WARM_UP_REPLIES = (
+    (Response, {
+        "id": "resp_warm_up", "object": "response", "created_at": 0, "model": "warm-up",
+        "status": "completed", "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+        "output": [{
+            "type": "message", "id": "msg_warm_up", "status": "completed", "role": "assistant",
+            "content": [{"type": "output_text", "text": "", "annotations": []}],
+        }],
+        "usage": {
+            "input_tokens": 0, "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": 0, "output_tokens_details": {"reasoning_tokens": 0}, "total_tokens": 0,
+        },
+    }),
+    (ChatCompletion, {
+        "id": "chatcmpl-warm-up", "object": "chat.completion", "created": 0, "model": "warm-up",
+        "choices": [{
+            "index": 0, "finish_reason": "stop", "logprobs": None,
+            "message": {"role": "assistant", "content": "", "refusal": None},
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }),
+)
+
+
+def warm_up_clients(workflows) -> None:
+    """
+    Load up front what the first request would otherwise do on the event loop:
+    import the client's API resources (openai imports each on first access),
+    build the reply validators, import the guardrail check modules and resolve
+    each agent's model.
+    """
+    client = get_openai_client()
+    client.responses
+    client.chat.completions
+    client.moderations
+    for model, reply in _WARM_UP_REPLIES:
+        # The same call the SDK makes on every reply
+        construct_type(type_=model, value=reply)
+    for workflow in workflows:
+        for guardrail in [*(workflow.guardrails or []), *(workflow.pii_guardrails or [])]:
+            module = getattr(guardrail.definition.check_fn, "__module__", None)
+            if module:
+                importlib.import_module(module)
+        for agent in workflow.agents.values():
+            workflow.run_config.model_provider.get_model(agent.model)
 
 
 # ----------------------------
-# Guardrails definitions
+# Guardrails
 # ----------------------------
-jailbreak_guardrail_config = {
-    "guardrails": [
-        {"name": "Jailbreak", "config": {"model": "gpt-5-nano", "confidence_threshold": 0.7}}
-    ]
-}
+def instantiate_guardrail_config(config):
+    """
+    Build guardrail instances for a config. Building them is not free, so each
+    BuiltWorkflow (see workflow_registry) does it once and owns the result.
+    """
+    bundle = load_config_bundle(config)
+    return instantiate_guardrails(bundle)
+
+
+def pii_only_config(config):
+    guardrails = (config or {}).get("guardrails") or []
+    pii = next((g for g in guardrails if (g or {}).get("name") == "Contains PII"), None)
+    if not pii:
+        return None
+    return {"guardrails": [pii]}
 
 
 def guardrails_has_tripwire(results):
@@ -82,17 +149,11 @@ def get_guardrail_safe_text(results, fallback_text):
     return fallback_text
 
 
-async def scrub_conversation_history(history, config):
+async def scrub_conversation_history(history, pii_guardrails):
     try:
-        guardrails = (config or {}).get("guardrails") or []
-        pii = next((g for g in guardrails if (g or {}).get("name") == "Contains PII"), None)
-        if not pii:
+        if not pii_guardrails:
             return
 
-        pii_only = {"guardrails": [pii]}
-        bundle = load_config_bundle(pii_only)
-        instantiated = instantiate_guardrails(bundle)
-
         for msg in (history or []):
             content = (msg or {}).get("content") or []
             for part in content:
@@ -102,10 +163,10 @@ async def scrub_conversation_history(history, config):
                     and isinstance(part.get("text"), str)
                 ):
                     res = await run_guardrails(
-                        ctx,
+                        guardrail_ctx(),
                         part["text"],
                         "text/plain",
-                        instantiated,
+                        pii_guardrails,
                         suppress_tripwire=True,
                         raise_guardrail_errors=True,
                     )
@@ -115,11 +176,9 @@ async def scrub_conversation_history(history, config):
         pass
 
 
-async def scrub_workflow_input(workflow, input_key, config):
+async def scrub_workflow_input(workflow, input_key, pii_guardrails):
     try:
-        guardrails = (config or {}).get("guardrails") or []
-        pii = next((g for g in guardrails if (g or {}).get("name") == "Contains PII"), None)
-        if not pii:
+        if not pii_guardrails:
             return
         if not isinstance(workflow, dict):
             return
@@ -128,15 +187,11 @@ async def scrub_workflow_input(workflow, input_key, config):
         if not isinstance(value, str):
             return
 
-        pii_only = {"guardrails": [pii]}
-        bundle = load_config_bundle(pii_only)
-        instantiated = instantiate_guardrails(bundle)
-
         res = await run_guardrails(
-            ctx,
+            guardrail_ctx(),
             value,
             "text/plain",
-            instantiated,
+            pii_guardrails,
             suppress_tripwire=True,
             raise_guardrail_errors=True,
         )
@@ -146,12 +201,9 @@ async def scrub_workflow_input(workflow, input_key, config):
         pass
 
 
-async def run_and_apply_guardrails(input_text, config, history, workflow):
-    bundle = load_config_bundle(config)
-    instantiated = instantiate_guardrails(bundle)
-
+async def run_and_apply_guardrails(input_text, config, history, workflow, instantiated, pii_instantiated=None):
     results = await run_guardrails(
-        ctx,
+        guardrail_ctx(),
         input_text,
         "text/plain",
         instantiated,
@@ -170,9 +222,9 @@ async def run_and_apply_guardrails(input_text, config, history, workflow):
     ) is not None
 
     if mask_pii:
-        await scrub_conversation_history(history, config)
-        await scrub_workflow_input(workflow, "input_as_text", config)
-        await scrub_workflow_input(workflow, "input_text", config)
+        await scrub_conversation_history(history, pii_instantiated)
+        await scrub_workflow_input(workflow, "input_as_text", pii_instantiated)
+        await scrub_workflow_input(workflow, "input_text", pii_instantiated)
 
     has_tripwire = guardrails_has_tripwire(results)
     safe_text = get_guardrail_safe_text(results, input_text)
@@ -244,279 +296,10 @@ def build_guardrail_fail_output(results):
     }
 
 
-# ----------------------------
-# Agents
-# ----------------------------
-class ClassificationAgentSchema(BaseModel):
-    classification: str
-
-
-classification_agent = Agent(
-    name="Classification agent",
-    instructions=(
-        "Classify the user’s intent into one of the following categories: "
-        '"return_item" or "get_information".\n\n'
-        "1. Any device-related return requests should route to return_item.\n"
-        "3. Any other requests should go to get_information."
-    ),
-    model="gpt-4.1-mini",
-    output_type=ClassificationAgentSchema,
-    model_settings=ModelSettings(
-        temperature=1,
-        top_p=1,
-        max_tokens=2048,
-        store=True,
-    ),
-)
-
-return_agent = Agent(
-    name="Return agent",
-    instructions="Offer a replacement device with free shipping.",
-    model="gpt-4.1-mini",
-    model_settings=ModelSettings(
-        temperature=1,
-        top_p=1,
-        max_tokens=2048,
-        store=True,
-    ),
-)
-
-retention_agent = Agent(
-    name="Retention Agent",
-    instructions=(
-        "You are a customer retention conversational agent whose goal is to prevent subscription cancellations. "
-        "Ask for their current plan and reason for dissatisfaction. "
-        "Use the get_retention_offers to identify return options. "
-        "For now, just say there is a 20% offer available for 1 year."
-    ),
-    model="gpt-4.1-mini",
-    tools=[get_retention_offers],
-    model_settings=ModelSettings(
-        temperature=1,
-        top_p=1,
-        parallel_tool_calls=True,
-        max_tokens=2048,
-        store=True,
-    ),
-)
-
-information_agent = Agent(
-    name="Information agent",
-    instructions="""You are an information agent for answering informational queries. Your aim is to provide clear, concise responses to user questions. Use the policy below to assemble your answer.
-
-Company Name: Milieu Insights Region: South East Asia
-Milieu Support Chatbot – Master Instruction Set
-General Rules
-Always answer using Milieu’s policies as defined below.
-Keep answers clear, friendly, and concise, but always include the required steps and conditions.
-When giving instructions that involve the Milieu app, reference paths like:
-Profile → Account
-Profile → More
-Profile → Ledger
-The agent must never invent policies. Only use rules listed in this document.
-If a user asks something outside these FAQs, instruct them to contact Milieu Support.
-1. ACCOUNT MANAGEMENT
-1.1 Account Verification
-Verification method depends on sign-up method:
-Facebook/Apple ID: No extra email; verification happens through the platform.
-Email signup: A verification email is sent to the user; they must open it and click the link.
-Advise users to check spam/junk folders.
-Support cannot manually activate accounts.
-Verified email must remain active for receiving rewards.
-1.2 Password Reset & Changes
-If user signed up with email:
-To reset password: use “I Forgot” on login page and follow the email link.
-To change password while logged in: go to Profile → Account.
-If user signed up with Facebook/Apple ID:
-They do not have a Milieu password; password changes occur on the external platform.
-1.3 Updating Personal Details
-Editable: first name, last name, language, password (email login only).
-Non-editable by user: birthdate and gender (critical for survey matching and verification).
-If these are incorrect/missing, instruct user to contact support.
-Inform user that birthdate/gender changes are normally allowed only once.
-1.4 Changing the Email Address
-Users cannot change emails themselves.
-Instruct them to contact support with:
-Current email
-New email
-Changes are subject to approval; policy allows one account per person/device.
-1.5 Suspended Accounts
-State possible reasons:
-Multiple accounts
-Identity misuse
-Repeated attention-check failures
-Low-quality responses
-Terms of Use violations
-Users may receive a suspension email.
-If they dispute suspension, direct them to contact support.
-1.6 Expired Accounts
-Accounts expire after 12 months of inactivity.
-Effects of inactivity:
-Badge resets to Explorer
-Boost resets
-All points expire
-Account may deactivate
-To avoid expiration: regularly do Surveys/Hot Topics/Quizzes.
-If already expired, user may appeal for reactivation.
-1.7 Issues With Apple “Hide My Email”
-Explain that Apple may generate a relay email.
-Verification and reward emails are sent to that relay, then forwarded to their private inbox.
-This is expected behavior.
-1.8 Account Deletion
-Path: Profile → Other → Delete my account.
-Deletion is permanent.
-All points, boosts, rewards, and badge levels are lost.
-Encourage contacting support if they suspect an issue before deleting.
-2. ACTIVITIES
-2.1 Hot Topics & Quizzes
-Hot Topics: opinion polls with instant results.
-Quizzes: knowledge checks; users can view info/facts after completion.
-Both award points.
-2.2 Boost & Streak Rules
-Badge Boost levels:
-Explorer: 0%
-Bronze: +3%
-Silver: +5%
-Gold: +10%
-Platinum: +15%
-Streak Boost:
-Complete 2 activities in 7 days to activate.
-Maintain by doing 2 activities every 7 days.
-Boosts apply to survey/quiz/hot topic points only.
-2.3 Why Two Different Point Figures
-Dark figure = Lifetime points
-Never decreases
-Used for badge progression
-Light figure = Available points
-Spent on rewards/donations
-Changes with redemptions
-Includes special/campaign bonus points
-2.4 Ledger & History
-Path: Profile → Ledger
-Show:
-Activity name & date
-Base points + boost
-Reward claims & refunds
-2.5 Attention Check Questions
-Designed to test attentiveness.
-Multiple recent failures can cause suspension.
-Warn users that careful reading is required.
-2.6 Activity Errors
-If user reports errors (no options, broken media, scroll issue, etc.):
-Request:
-Phone model
-OS version
-App version (Profile → More)
-Name of survey
-Date
-Screenshots/recordings
-Advise that support can investigate.
-2.7 Changing Submitted Responses
-Users cannot edit survey answers after submission.
-Encourage reading questions carefully.
-Only attention checks have “correct” answers.
-2.8 Not Receiving Surveys
-Possible causes:
-Missing or incorrect birthdate/gender
-Natural drop after intro surveys
-Limited survey quotas
-Notifications clicked too late
-Recommendations:
-Log in regularly
-Keep app updated
-Check birthdate/gender accuracy
-3. DONATIONS
-3.1 How Donations Are Processed
-All donations for a month are processed at the start of next month.
-Donor receives a confirmation email.
-Partners receive the contributor list.
-For donation-specific issues, contact the charity partner.
-3.2 Donation Points Not Deducted
-Processing time: up to 1 working day.
-If user redeems another reward before donation completes and balance becomes insufficient, donation fails.
-Confirmation email indicates approval/rejection.
-Users can check status in Ledger.
-4. TECHNICAL TROUBLESHOOTING
-4.1 App Crashing
-Recommend uninstall → reinstall.
-Points & status remain safe.
-For Android:
-Use latest version
-Older OS versions may have issues
-Clear cache/data before reinstall
-Request device/app info if issue continues.
-4.2 App Not Downloading
-Device may not meet compatibility requirements.
-Explain that Milieu is improving support for more devices over time.
-5. REWARDS & REFERRALS
-5.1 Reward Redemption
-Steps:
-Tap Ticket icon
-Select a reward
-Tap Claim
-Fill accurate details (email + phone)
-Check confirmation email (spam/junk included)
-Rewards cannot be refunded or modified by partners easily.
-5.2 Reward Processing Time
-Normally 10 working days.
-Reward partner sends email/SMS.
-If nothing is received after 10 working days, user must provide:
-Reward reference number
-Reward type
-Redemption date
-Mobile number
-Rewards cannot be cancelled or changed once processed.
-5.3 Reward Activation Rules
-For vouchers/e-wallet:
-User receives partner email with link
-Must activate via link
-Merchant contact required if code fails
-For prepaid credit:
-SMS confirms credit added
-Telecom operator handles missing balance issues
-5.4 Refunded Reward Points
-Occurs when partner cannot deliver due to invalid email/phone.
-Points return to balance.
-User may submit a new claim.
-Persistent issues should go to support.
-5.5 Changing Reward Details
-Before submission: check correctness.
-After submission:
-User must contact support within 48 hours.
-Changes depend on partner approval.
-Once delivered, rewards cannot be reversed.
-5.6 Expired Rewards
-Must be activated before expiry date.
-Once expired:
-Reward becomes void
-Points are not refunded
-No replacement possible
-6. REFER A FRIEND
-6.1 Referral Rules
-Referral code is case-sensitive.
-Friend must enter code at registration (cannot be added later).
-Friend must complete 7 surveys.
-Both users receive 500 points automatically upon completion.
-Misuse of referral system may lead to suspension.
-Referral rewards stop once limit is reached.
-6.2 Viewing Referral Details
-Path: Profile → More
-Shows:
-Referral code
-Copy/share options
-Referral count
-Referral cap
-Successful when:
-Friend signs up with code
-Friend completes 7 surveys""",
-    model="gpt-4.1-mini",
-    model_settings=ModelSettings(
-        temperature=1,
-        top_p=1,
-        max_tokens=2048,
-        store=True,
-    ),
-)
+# Tools a workflow definition may reference by name
+TOOLS = {
+    "get_retention_offers": get_retention_offers,
+}
 
 
 def approval_request(message: str) -> bool:
@@ -528,81 +311,142 @@ class WorkflowInput(BaseModel):
     input_as_text: str
 
 
+def record_agent_usage(usage, key, agent, result, elapsed_ms):
+    """
+    Append one agent run's token counts to a usage record (see usage_ledger).
+    """
+    if usage is None:
+        return
+    u = result.context_wrapper.usage
+    details = getattr(u, "input_tokens_details", None)
+    usage.setdefault("agents", []).append({
+        "agent": key,
+        "model": str(agent.model),
+        "ms": round(elapsed_ms, 1),
+        "req": u.requests,
+        "in": u.input_tokens,
+        "out": u.output_tokens,
+        "cached": (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0,
+    })
+
+
+def record_guardrail_usage(usage, config, results, elapsed_ms):
+    """
+    Append one entry per LLM-based guardrail (those reporting `token_usage` in their info).
+    """
+    if usage is None:
+        return
+    models = {
+        (g or {}).get("name"): ((g or {}).get("config") or {}).get("model")
+        for g in ((config or {}).get("guardrails") or [])
+    }
+    for r in (results or []):
+        info = (r.info if hasattr(r, "info") else None) or {}
+        token_usage = info.get("token_usage") if isinstance(info, dict) else None
+        if not isinstance(token_usage, dict):
+            continue
+        name = info.get("guardrail_name") or info.get("guardrailName")
+        usage.setdefault("agents", []).append({
+            "agent": f"guardrail:{name}",
+            "model": str(models.get(name)),
+            # Guardrails run concurrently; this is the whole guardrails stage
+            "ms": round(elapsed_ms, 1),
+            "req": 1,
+            "in": token_usage.get("prompt_tokens") or 0,
+            "out": token_usage.get("completion_tokens") or 0,
+            "cached": 0,
+        })
+
+
 # ----------------------------
 # Main entrypoint
 # ----------------------------
-async def run_workflow(workflow_input: WorkflowInput):
-    with trace("Milieu Agent"):
-        workflow = workflow_input.model_dump()
+async def run_workflow(workflow_input: WorkflowInput, workflow=None, usage: Optional[dict] = None):
+    """
+    Run one request through a built workflow (see workflow_registry).
+    Defaults to the registry's default workflow.
+
+    If `usage` is given it is filled in with the branch taken, per-stage
+    timings (ms) and per-agent token counts.
+    """
+    if workflow is None:
+        from workflow_registry import registry
+        workflow = registry.get()
+
+    routing = workflow.definition.routing
+    run_config = workflow.run_config
+    stages = {}
+    if usage is not None:
+        usage.update({"workflow": workflow.id, "version": workflow.version, "stages": stages})
+
+    with trace(workflow.definition.trace_name):
+        workflow_state = workflow_input.model_dump()
 
         conversation_history: list[TResponseInputItem] = [
             {
                 "role": "user",
-                "content": [{"type": "input_text", "text": workflow["input_as_text"]}],
+                "content": [{"type": "input_text", "text": workflow_state["input_as_text"]}],
             }
         ]
 
-        guardrails_input_text = workflow["input_as_text"]
+        t0 = time.perf_counter()
+        guardrails_input_text = workflow_state["input_as_text"]
         guardrails_result = await run_and_apply_guardrails(
             guardrails_input_text,
-            jailbreak_guardrail_config,
+            workflow.guardrails_config,
             conversation_history,
-            workflow,
+            workflow_state,
+            workflow.guardrails,
+            workflow.pii_guardrails,
         )
+        stages["guardrails"] = round((time.perf_counter() - t0) * 1000, 1)
+        record_guardrail_usage(usage, workflow.guardrails_config, guardrails_result["results"], stages["guardrails"])
+
+        if usage is not None:
+            usage["tripwire"] = guardrails_result["has_tripwire"]
 
         if guardrails_result["has_tripwire"]:
+            if usage is not None:
+                usage["branch"] = "tripwire"
             return guardrails_result["fail_output"]
 
         # Classification
+        classifier = workflow.agents[routing.classifier]
+        t0 = time.perf_counter()
         classification_agent_result_temp = await Runner.run(
-            classification_agent,
+            classifier,
             input=[*conversation_history],
-            run_config=RunConfig(
-                trace_metadata={
-                    "__trace_source__": "agent-builder",
-                    "workflow_id": "wf_694a718c9964819089160a7912c26ee40d01ca396fad04f0",
-                }
-            ),
+            run_config=run_config,
         )
+        stages["classify"] = round((time.perf_counter() - t0) * 1000, 1)
+        record_agent_usage(usage, routing.classifier, classifier, classification_agent_result_temp, stages["classify"])
 
         conversation_history.extend([item.to_input_item() for item in classification_agent_result_temp.new_items])
 
-        classification = classification_agent_result_temp.final_output.model_dump().get("classification")
+        classification = classification_agent_result_temp.final_output.model_dump().get(routing.field)
 
-        if classification == "return_item":
-            return_agent_result_temp = await Runner.run(
-                return_agent,
-                input=[*conversation_history],
-                run_config=RunConfig(
-                    trace_metadata={
-                        "__trace_source__": "agent-builder",
-                        "workflow_id": "wf_694a718c9964819089160a7912c26ee40d01ca396fad04f0",
-                    }
-                ),
-            )
-
-            conversation_history.extend([item.to_input_item() for item in return_agent_result_temp.new_items])
+        route = routing.routes.get(classification)
+        if usage is not None:
+            usage["branch"] = classification if route is not None else "fallback"
 
-            approval_message = "Does this work for you?"
-            if approval_request(approval_message):
-                return {"message": "Your return is on the way."}
-            return {"message": "What else can I help you with?"}
-
-        if classification == "get_information":
-            information_agent_result_temp = await Runner.run(
-                information_agent,
+        if route is not None:
+            route_agent = workflow.agents[route.agent]
+            t0 = time.perf_counter()
+            route_agent_result_temp = await Runner.run(
+                route_agent,
                 input=[*conversation_history],
-                run_config=RunConfig(
-                    trace_metadata={
-                        "__trace_source__": "agent-builder",
-                        "workflow_id": "wf_694a718c9964819089160a7912c26ee40d01ca396fad04f0",
-                    }
-                ),
+                run_config=run_config,
             )
-            conversation_history.extend([item.to_input_item() for item in information_agent_result_temp.new_items])
+            stages["route"] = round((time.perf_counter() - t0) * 1000, 1)
+            record_agent_usage(usage, route.agent, route_agent, route_agent_result_temp, stages["route"])
+            conversation_history.extend([item.to_input_item() for item in route_agent_result_temp.new_items])
+
+            if route.approval_message is not None:
+                if approval_request(route.approval_message):
+                    return {"message": route.approved_reply}
+                return {"message": route.rejected_reply}
 
-            # ✅ FIX: return the information agent result (your export computed it but didn't return)
-            return {"message": information_agent_result_temp.final_output_as(str)}
+            return {"message": route_agent_result_temp.final_output_as(str)}
 
         # Fallback
         return {
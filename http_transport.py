@@ -0,0 +1,336 @@
+# http_transport.py
+"""
+One shared, tuned HTTP transport for every outbound OpenAI call.
+
+The agents Runner, the guardrails `ctx.guardrail_llm` and the ChatKit session
+call all go through the same httpx.AsyncClient, so they share one connection
+pool (and one set of TLS handshakes) per worker.
+
+Settings (env):
+    OPENAI_HTTP_MAX_CONNECTIONS            total pool size (default 100)
+    OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS  idle connections kept open (default 20)
+    OPENAI_HTTP_KEEPALIVE_EXPIRY           seconds an idle connection lives (default 30)
+    OPENAI_HTTP2                           "1" to negotiate HTTP/2 (default 1, needs `h2`)
+    OPENAI_HTTP_CONNECT_TIMEOUT            seconds (default 5)
+    OPENAI_HTTP_READ_TIMEOUT               seconds (default 60)
+    OPENAI_HTTP_WRITE_TIMEOUT              seconds (default 10)
+    OPENAI_HTTP_POOL_TIMEOUT               seconds to wait for a free connection (default 10)
+    OPENAI_HTTP_PREWARM                    connections to open at startup (default 2)
+    OPENAI_BASE_URL                        API base (default https://api.openai.com/v1)
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Any, Callable, Optional
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+
+# ----------------------------
+# Settings
+# ----------------------------
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def load_settings() -> dict:
+    """
+    Read transport settings from the environment, including .env.
+    """
+    # Importers may run before server.py's load_dotenv(); existing env vars still win
+    load_dotenv()
+
+    http2 = _env_bool("OPENAI_HTTP2", True)
+    if http2 and not _http2_available():
+        print("WARNING: OPENAI_HTTP2 is on but the `h2` package is missing; using HTTP/1.1")
+        http2 = False
+
+    return {
+        "base_url": os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+        "max_connections": _env_int("OPENAI_HTTP_MAX_CONNECTIONS", 100),
+        "max_keepalive_connections": _env_int("OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20),
+        "keepalive_expiry": _env_float("OPENAI_HTTP_KEEPALIVE_EXPIRY", 30.0),
+        "http2": http2,
+        "connect_timeout": _env_float("OPENAI_HTTP_CONNECT_TIMEOUT", 5.0),
+        "read_timeout": _env_float("OPENAI_HTTP_READ_TIMEOUT", 60.0),
+        "write_timeout": _env_float("OPENAI_HTTP_WRITE_TIMEOUT", 10.0),
+        "pool_timeout": _env_float("OPENAI_HTTP_POOL_TIMEOUT", 10.0),
+        "prewarm": _env_int("OPENAI_HTTP_PREWARM", 2),
+    }
+
+
+# ----------------------------
+# Pool instrumentation
+# ----------------------------
+class _ReleasingStream(httpx.AsyncByteStream):
+    """
+    Wraps a response body so the transport knows when the connection is handed back.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """
+    Tracks in-flight requests and the connections actually open in the pool.
+
+    The pool counts as saturated when it holds `max_connections` connections and
+    none can take another request. With HTTP/2 one connection carries many
+    streams, so in-flight requests alone say nothing about saturation.
+    """
+
+    def __init__(self, inner: httpx.AsyncHTTPTransport, max_connections: int):
+        self._inner = inner
+        self.max_connections = max_connections
+        self.in_flight_requests = 0
+        self.peak_in_flight_requests = 0
+        self.peak_connections = 0
+        self.total_requests = 0
+        self.saturated_requests = 0
+        self.pool_timeouts = 0
+        self.last_saturated_at: Optional[float] = None
+
+    def _connections(self) -> Optional[list]:
+        # httpx keeps its httpcore pool private; degrade to no connection stats if that changes
+        pool = getattr(self._inner, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return list(connections) if connections is not None else None
+
+    def _saturated(self) -> bool:
+        connections = self._connections()
+        if connections is None:
+            return False
+        if len(connections) < self.max_connections:
+            return False
+        return not any(c.is_available() for c in connections)
+
+    def _release(self) -> None:
+        self.in_flight_requests -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.total_requests += 1
+        if self._saturated():
+            # This request will queue for a free connection
+            self.saturated_requests += 1
+            if self.last_saturated_at is None or time.time() - self.last_saturated_at > 60:
+                print(f"WARNING: OpenAI HTTP pool saturated ({self.max_connections} connections busy)")
+            self.last_saturated_at = time.time()
+
+        self.in_flight_requests += 1
+        self.peak_in_flight_requests = max(self.peak_in_flight_requests, self.in_flight_requests)
+        try:
+            response = await self._inner.handle_async_request(request)
+        except httpx.PoolTimeout:
+            self.pool_timeouts += 1
+            self._release()
+            raise
+        except BaseException:
+            self._release()
+            raise
+
+        connections = self._connections()
+        if connections is not None:
+            self.peak_connections = max(self.peak_connections, len(connections))
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, self._release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+    def stats(self) -> dict:
+        connections = self._connections()
+        stats = {
+            "max_connections": self.max_connections,
+            "in_flight_requests": self.in_flight_requests,
+            "peak_in_flight_requests": self.peak_in_flight_requests,
+            "total_requests": self.total_requests,
+            "saturated_requests": self.saturated_requests,
+            "pool_timeouts": self.pool_timeouts,
+            "last_saturated_at": self.last_saturated_at,
+        }
+        if connections is not None:
+            stats.update({
+                "open_connections": len(connections),
+                "idle_connections": sum(1 for c in connections if c.is_idle()),
+                "peak_connections": self.peak_connections,
+                "utilization": round(len(connections) / self.max_connections, 3) if self.max_connections else None,
+            })
+        return stats
+
+
+# ----------------------------
+# Shared clients
+# ----------------------------
+_settings: Optional[dict] = None
+_transport: Optional[InstrumentedTransport] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_openai_client: Optional[AsyncOpenAI] = None
+_client_listeners: list[Callable[[AsyncOpenAI], Any]] = []
+
+
+def _timeout(settings: dict) -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=settings["connect_timeout"],
+        read=settings["read_timeout"],
+        write=settings["write_timeout"],
+        pool=settings["pool_timeout"],
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    The process-wide httpx client. Every OpenAI request should go through this.
+    """
+    global _settings, _transport, _http_client
+    if _http_client is None:
+        _settings = load_settings()
+        limits = httpx.Limits(
+            max_connections=_settings["max_connections"],
+            max_keepalive_connections=_settings["max_keepalive_connections"],
+            keepalive_expiry=_settings["keepalive_expiry"],
+        )
+        inner = httpx.AsyncHTTPTransport(limits=limits, http2=_settings["http2"])
+        _transport = InstrumentedTransport(inner, _settings["max_connections"])
+        _http_client = httpx.AsyncClient(
+            transport=_transport,
+            timeout=_timeout(_settings),
+        )
+    return _http_client
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """
+    AsyncOpenAI bound to the shared transport.
+    """
+    global _openai_client
+    if _openai_client is None:
+        http_client = get_http_client()
+        _openai_client = AsyncOpenAI(
+            base_url=_settings["base_url"],
+            http_client=http_client,
+            # the SDK's own default (600s) would override the client timeout per request
+            timeout=_timeout(_settings),
+        )
+        for listener in _client_listeners:
+            listener(_openai_client)
+    return _openai_client
+
+
+def on_openai_client(listener: Callable[[AsyncOpenAI], Any]) -> None:
+    """
+    Call `listener(client)` with the current client and with every one built later.
+    """
+    _client_listeners.append(listener)
+    if _openai_client is not None:
+        listener(_openai_client)
+
+
+def base_url() -> str:
+    get_http_client()
+    return _settings["base_url"]
+
+
+async def prewarm() -> int:
+    """
+    Open connections ahead of the first real request. Best-effort; returns how many succeeded.
+    """
+    http_client = get_http_client()
+    count = max(0, _settings["prewarm"])
+    if count == 0:
+        return 0
+
+    # HTTP/2 multiplexes over a single connection
+    if _settings["http2"]:
+        count = 1
+
+    headers = {}
+    api_key = os.getenv("OPENAI_API_KEY")
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+
+    async def _one():
+        # The response body is discarded; we only want the TLS session in the pool
+        resp = await http_client.get(f"{base_url()}/models", headers=headers)
+        return resp.status_code
+
+    results = await asyncio.gather(*[_one() for _ in range(count)], return_exceptions=True)
+    ok = sum(1 for r in results if not isinstance(r, BaseException))
+    for r in results:
+        if isinstance(r, BaseException):
+            print("WARNING: HTTP pre-warm failed:", r)
+    return ok
+
+
+def pool_stats() -> dict[str, Any]:
+    if _transport is None:
+        return {"initialized": False}
+    return {
+        "initialized": True,
+        "http2": _settings["http2"],
+        "keepalive_expiry": _settings["keepalive_expiry"],
+        "max_keepalive_connections": _settings["max_keepalive_connections"],
+        **_transport.stats(),
+    }
+
+
+async def aclose() -> None:
+    """
+    Close the shared client at shutdown. The next get_*_client() call builds a
+    fresh one, but objects that already resolved the old client (e.g. a
+    workflow's RunConfig provider) keep it.
+    """
+    global _transport, _http_client, _openai_client
+    if _http_client is not None:
+        await _http_client.aclose()
+    _transport = None
+    _http_client = None
+    _openai_client = None
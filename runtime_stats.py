@@ -0,0 +1,245 @@
+# runtime_stats.py
+"""
+Process health numbers for long-running workers: RSS, event-loop lag and
+tracemalloc top allocators. Served live by /debug/runtime (needs DEBUG_TOKEN, see
+server.py) and sampled by soak.py.
+
+Settings (env):
+    DEBUG_TRACEMALLOC        frames to record per allocation, 0 disables (default 0)
+    LOOP_LAG_INTERVAL        seconds between loop-lag probes (default 0.1)
+    LOOP_LAG_STALL_MS        lag counted (and logged) as a stall (default 250)
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import gc
+import linecache
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from typing import Any, Optional
+
+
+DEBUG_TRACEMALLOC = int(os.getenv("DEBUG_TRACEMALLOC", "0"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_STALL_MS = float(os.getenv("LOOP_LAG_STALL_MS", "250"))
+
+
+# ----------------------------
+# Memory
+# ----------------------------
+def rss_bytes() -> Optional[int]:
+    """
+    Current resident set size. Linux only; None elsewhere (see peak_rss_bytes).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+_baseline_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+def start_tracemalloc(frames: int = DEBUG_TRACEMALLOC) -> bool:
+    """
+    Start tracing. The growth baseline is taken later by reset_baseline(), once
+    startup imports are done, so they do not swamp real leaks.
+    """
+    if frames <= 0:
+        return False
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return True
+
+
+@contextlib.contextmanager
+def _capturing():
+    # Snapshots, statistics() and compare_to() hold the GIL while walking every
+    # trace, which stalls the event loop even from a thread; keep that lag out
+    # of the loop-lag numbers
+    loop_lag.capture_started()
+    try:
+        yield
+    finally:
+        loop_lag.capture_finished()
+
+
+def reset_baseline() -> bool:
+    """
+    Make allocation "growth" relative to now. Called (with loop_lag.reset()) once
+    the worker is warm, and by soak.py at the end of its warm-up period.
+    """
+    global _baseline_snapshot
+    if not tracemalloc.is_tracing():
+        return False
+    with _capturing():
+        _baseline_snapshot = _snapshot()
+    return True
+
+
+def tracemalloc_top(limit: int = 10) -> dict[str, Any]:
+    """
+    Largest live allocation sites, and the sites that grew most since the baseline.
+    Taking a snapshot walks every traced block, so keep this off hot paths.
+    """
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    with _capturing():
+        return _top(_snapshot(), limit)
+
+
+def _top(snapshot: tracemalloc.Snapshot, limit: int) -> dict[str, Any]:
+    current, peak = tracemalloc.get_traced_memory()
+
+    def _row(stat) -> dict:
+        frame = stat.traceback[0]
+        row = {"where": f"{frame.filename}:{frame.lineno}", "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+        if hasattr(stat, "size_diff"):
+            row["size_diff_kb"] = round(stat.size_diff / 1024, 1)
+            row["count_diff"] = stat.count_diff
+        return row
+
+    result = {
+        "tracing": True,
+        "traced_kb": round(current / 1024, 1),
+        "traced_peak_kb": round(peak / 1024, 1),
+        "top": [_row(s) for s in snapshot.statistics("lineno")[:limit]],
+    }
+    if _baseline_snapshot is not None:
+        growth = snapshot.compare_to(_baseline_snapshot, "lineno")
+        result["top_growth"] = [_row(s) for s in growth[:limit]]
+    return result
+
+
+# ----------------------------
+# Event loop lag
+# ----------------------------
+class LoopLagMonitor:
+    """
+    Sleeps `interval` in a loop and records how late each wake-up is. Lag here
+    means something blocked the event loop (sync I/O, heavy CPU, a big GC pass).
+
+    Wake-ups that overlap a tracemalloc capture are kept out of the regular
+    numbers and reported as `capture_max_ms`, since the probe would otherwise
+    measure the measurement.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, stall_ms: float = LOOP_LAG_STALL_MS, window: int = 600):
+        self.interval = interval
+        self.stall_ms = stall_ms
+        self.samples: collections.deque = collections.deque(maxlen=window)
+        self.max_ms = 0.0
+        self.stalls = 0
+        self.capture_max_ms = 0.0
+        self.started_at: Optional[float] = None
+        self.reset_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        # Captures run in threads and may overlap (e.g. a reset and a dump)
+        self._capture_lock = threading.Lock()
+        self._captures = 0
+        self._capture_gen = 0
+
+    def capture_started(self) -> None:
+        with self._capture_lock:
+            self._captures += 1
+            self._capture_gen += 1
+
+    def capture_finished(self) -> None:
+        with self._capture_lock:
+            self._captures -= 1
+            self._capture_gen += 1
+
+    def reset(self) -> None:
+        """
+        Forget the lag seen so far (e.g. during warm-up). Call on the event loop.
+        """
+        self.samples.clear()
+        self.max_ms = 0.0
+        self.stalls = 0
+        self.capture_max_ms = 0.0
+        self.reset_at = time.time()
+
+    def start(self) -> None:
+        if self._task is None:
+            self.started_at = time.time()
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            gen = self._capture_gen
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - t0 - self.interval) * 1000)
+            if self._captures or gen != self._capture_gen:
+                self.capture_max_ms = max(self.capture_max_ms, lag_ms)
+                continue
+            self.samples.append(lag_ms)
+            self.max_ms = max(self.max_ms, lag_ms)
+            if lag_ms >= self.stall_ms:
+                self.stalls += 1
+                if lag_ms >= 1000:
+                    print(f"WARNING: event loop stalled for {lag_ms:.0f} ms")
+
+    def stats(self) -> dict[str, Any]:
+        recent = sorted(self.samples)
+        return {
+            "interval_ms": self.interval * 1000,
+            "last_ms": round(self.samples[-1], 1) if self.samples else None,
+            "recent_p99_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.99))], 1) if recent else None,
+            "recent_max_ms": round(recent[-1], 1) if recent else None,
+            "max_ms": round(self.max_ms, 1),
+            "stalls": self.stalls,
+            "stall_threshold_ms": self.stall_ms,
+            "capture_max_ms": round(self.capture_max_ms, 1),
+            # max_ms, stalls and capture_max_ms count from here
+            "reset_at": self.reset_at,
+        }
+
+
+loop_lag = LoopLagMonitor()
+
+
+def snapshot() -> dict[str, Any]:
+    """
+    Cheap process stats; call on the event loop. tracemalloc_top() is separate
+    because it is slow enough to belong in a thread.
+    """
+    return {
+        "pid": os.getpid(),
+        "uptime_s": round(time.time() - loop_lag.started_at, 1) if loop_lag.started_at else None,
+        "rss_bytes": rss_bytes(),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "gc_counts": gc.get_count(),
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "loop_lag": loop_lag.stats(),
+    }
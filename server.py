@@ -1,25 +1,164 @@
 # server.py
+import asyncio
+import hmac
+import importlib
 import os
+import time
 import traceback
+from contextlib import asynccontextmanager
 from typing import Optional, Any
 
-import requests
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from fastapi import Response
 
-from agent_workflow import run_workflow, WorkflowInput  # uses your exported agent
-
 load_dotenv()
+# openai defers building its response models until the first one is parsed,
+# which would be the first request; build them during the warm-up imports instead
+os.environ.setdefault("DEFER_PYDANTIC_BUILD", "false")
+
+import runtime_stats  # noqa: E402  (both read their settings from the environment)
+import usage_ledger  # noqa: E402
+
+
+# ----------------------------
+# Startup / readiness
+# ----------------------------
+# agent_workflow pulls in agents, openai and guardrails and builds every Agent,
+# so it is imported in the background once the port is open instead of at
+# module import. /healthz answers straight away; /readyz only once warm.
+WARMUP_IMPORTS = (
+    "openai", "agents", "guardrails.runtime", "http_transport", "agent_workflow", "workflow_registry",
+)
+
+http_transport: Any = None
+agent_workflow: Any = None  # uses your exported agent
+workflow_registry: Any = None
+
+# Failed warm-ups are retried with backoff; after the last attempt /healthz
+# fails too so the orchestrator recycles the worker instead of leaving it stuck.
+WARMUP_ATTEMPTS = int(os.getenv("WARMUP_ATTEMPTS", "5"))
+WARMUP_MAX_BACKOFF = float(os.getenv("WARMUP_MAX_BACKOFF", "60"))
+
+_warmup_task: Optional[asyncio.Task] = None
+_reload_task: Optional[asyncio.Task] = None
+_first_attempt_done: Optional[asyncio.Event] = None
+startup_state: dict[str, Any] = {"ready": False, "failed": False, "attempts": 0, "error": None, "timings_ms": {}}
+
+
+async def warm_up_once():
+    global http_transport, agent_workflow, workflow_registry, _reload_task
+    timings = startup_state["timings_ms"]
+    timings.clear()
+    t_start = time.perf_counter()
+
+    # Imported one by one so the timings break down per package
+    for name in WARMUP_IMPORTS:
+        t0 = time.perf_counter()
+        await asyncio.to_thread(importlib.import_module, name)
+        timings[f"import {name}"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    http_transport = importlib.import_module("http_transport")
+    agent_workflow = importlib.import_module("agent_workflow")
+    workflow_registry = importlib.import_module("workflow_registry")
+
+    for step, ms in (await asyncio.to_thread(workflow_registry.warm_up)).items():
+        timings[f"warm {step}"] = round(ms, 1)
+    if workflow_registry.WORKFLOW_RELOAD_INTERVAL > 0 and _reload_task is None:
+        _reload_task = asyncio.create_task(workflow_registry.registry.watch())
+
+    t0 = time.perf_counter()
+    warmed = await http_transport.prewarm()
+    timings["warm http"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    timings["total"] = round((time.perf_counter() - t_start) * 1000, 1)
+    print(f"Worker ready in {timings['total']} ms ({warmed} connection(s) pre-warmed)")
+
+
+async def warm_up():
+    delay = 1.0
+    for attempt in range(1, WARMUP_ATTEMPTS + 1):
+        startup_state["attempts"] = attempt
+        try:
+            await warm_up_once()
+            startup_state["ready"] = True
+            startup_state["error"] = None
+            # Allocator growth and loop-lag max are measured from here, not from startup
+            await reset_runtime_baseline()
+            return
+        except Exception as e:
+            startup_state["error"] = str(e)
+            print(f"ERROR during warm-up (attempt {attempt}/{WARMUP_ATTEMPTS}):", e)
+            traceback.print_exc()
+        finally:
+            _first_attempt_done.set()
+
+        if attempt < WARMUP_ATTEMPTS:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_MAX_BACKOFF)
+
+    startup_state["failed"] = True
+    print("ERROR: giving up on warm-up; /healthz now fails so the worker is restarted")
+
+
+async def reset_runtime_baseline() -> bool:
+    tracing = await asyncio.to_thread(runtime_stats.reset_baseline)
+    runtime_stats.loop_lag.reset()
+    return tracing
+
 
-app = FastAPI()
+async def wait_until_ready():
+    """
+    Requests that arrive before the first warm-up attempt finishes wait for it
+    rather than racing it. While later retries run they get a 503 straight away.
+    """
+    if startup_state["ready"]:
+        return
+    if _first_attempt_done is not None:
+        await _first_attempt_done.wait()
+    if not startup_state["ready"]:
+        raise HTTPException(503, f"Worker failed to warm up: {startup_state['error']}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _warmup_task, _first_attempt_done
+    _first_attempt_done = asyncio.Event()
+    runtime_stats.start_tracemalloc()
+    runtime_stats.loop_lag.start()
+    if usage_ledger.ledger is not None:
+        usage_ledger.ledger.start()
+    _warmup_task = asyncio.create_task(warm_up())
+    yield
+    if not _warmup_task.done():
+        _warmup_task.cancel()
+    if _reload_task is not None:
+        _reload_task.cancel()
+    if http_transport is not None:
+        await http_transport.aclose()
+    if usage_ledger.ledger is not None:
+        await asyncio.to_thread(usage_ledger.ledger.close)
+    runtime_stats.loop_lag.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Get health endpoint
 @app.api_route("/healthz", methods=["GET", "HEAD"])
 async def healthz():
-    return Response(status_code=200)
+    return Response(status_code=503 if startup_state["failed"] else 200)
+
+
+# Readiness: only route traffic here once agents/guardrails/connections are warm
+@app.api_route("/readyz", methods=["GET", "HEAD"])
+async def readyz():
+    return JSONResponse(
+        status_code=200 if startup_state["ready"] else 503,
+        content=startup_state,
+    )
 
 # CORS so Freshdesk + n8n can call the backend
 app.add_middleware(
@@ -32,6 +171,9 @@ app.add_middleware(
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 CHATKIT_WORKFLOW_ID = os.getenv("CHATKIT_WORKFLOW_ID")
+# /debug/* answers only when this is set and sent back as X-Debug-Token
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+DEBUG_TRACEMALLOC_MAX_TOP = 50
 
 
 # ----------------------------
@@ -44,6 +186,8 @@ class SessionRequest(BaseModel):
 class N8nChatRequest(BaseModel):
     sessionId: Optional[str] = None
     message: str
+    # Registry workflow id; the default workflow when omitted
+    workflowId: Optional[str] = None
 
 
 # ----------------------------
@@ -85,6 +229,50 @@ async def root():
     }
 
 
+@app.get("/workflows")
+async def list_workflows():
+    await wait_until_ready()
+    return {
+        "default": workflow_registry.registry.default_id,
+        "workflows": workflow_registry.registry.list(),
+    }
+
+
+def require_debug_token(x_debug_token: Optional[str] = Header(None)):
+    # 404 rather than 401/403 so the endpoints do not advertise themselves
+    if not DEBUG_TOKEN or not x_debug_token or not hmac.compare_digest(x_debug_token, DEBUG_TOKEN):
+        raise HTTPException(404, "Not Found")
+
+
+@app.get("/debug/http-pool", dependencies=[Depends(require_debug_token)])
+async def http_pool():
+    if http_transport is None:
+        return {"initialized": False}
+    return http_transport.pool_stats()
+
+
+@app.get("/debug/runtime", dependencies=[Depends(require_debug_token)])
+async def debug_runtime(top: int = 10, reset_baseline: bool = False):
+    """
+    RSS, event-loop lag and (with DEBUG_TRACEMALLOC set) top allocators for this worker.
+    `reset_baseline` makes later `top_growth`, loop-lag max and stalls relative to now.
+    """
+    stats = runtime_stats.snapshot()
+    stats["ready"] = startup_state["ready"]
+    if http_transport is not None:
+        stats["http_pool"] = http_transport.pool_stats()
+    if usage_ledger.ledger is not None:
+        stats["usage_ledger"] = usage_ledger.ledger.stats()
+    if workflow_registry is not None:
+        stats["workflows"] = workflow_registry.registry.list()
+    if reset_baseline:
+        stats["baseline_reset"] = await reset_runtime_baseline()
+    if top > 0:
+        top = min(top, DEBUG_TRACEMALLOC_MAX_TOP)
+        stats["tracemalloc"] = await asyncio.to_thread(runtime_stats.tracemalloc_top, top)
+    return stats
+
+
 # ----------------------------
 # ChatKit session endpoint (Freshdesk ChatKit widget)
 # ----------------------------
@@ -97,9 +285,11 @@ async def create_chatkit_session(body: SessionRequest):
 
     user = body.user_id or "anonymous"
 
+    await wait_until_ready()
+
     try:
-        resp = requests.post(
-            "https://api.openai.com/v1/chatkit/sessions",
+        resp = await http_transport.get_http_client().post(
+            f"{http_transport.base_url()}/chatkit/sessions",
             headers={
                 "Authorization": f"Bearer {OPENAI_API_KEY}",
                 "Content-Type": "application/json",
@@ -109,7 +299,7 @@ async def create_chatkit_session(body: SessionRequest):
             timeout=20,
         )
 
-        if not resp.ok:
+        if not resp.is_success:
             raise HTTPException(
                 status_code=500,
                 detail=f"OpenAI ChatKit error {resp.status_code}: {resp.text}",
@@ -142,15 +332,29 @@ async def n8n_chat(req: N8nChatRequest):
     n8n sends: { "sessionId": "...", "message": "..." }
     We run the SAME exported Agent Builder workflow and return: { "reply": "..." }
     """
+    await wait_until_ready()
+
+    try:
+        # Pin the current version; a hot reload mid-request does not affect this run
+        workflow = workflow_registry.registry.get(req.workflowId)
+    except workflow_registry.WorkflowNotFound:
+        raise HTTPException(404, f"Unknown workflow: {req.workflowId}")
+
+    usage = usage_ledger.new_record(req.sessionId)
+    started = time.perf_counter()
+    ok = False
     try:
         # Run the exported agent workflow (async)
-        workflow_input = WorkflowInput(input_as_text=req.message)
-        result = await run_workflow(workflow_input)
+        workflow_input = agent_workflow.WorkflowInput(input_as_text=req.message)
+        result = await agent_workflow.run_workflow(workflow_input, workflow, usage=usage)
 
         reply_text = extract_reply_text(result)
+        ok = True
         return {"reply": reply_text}
 
     except Exception as e:
         print("ERROR in /n8n/chat:", e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        usage_ledger.finish_record(usage, ok, started)
@@ -0,0 +1,499 @@
+# soak.py
+"""
+Long-running soak test for a worker: memory growth and event-loop stalls.
+
+`run` starts a stub OpenAI server and a real `uvicorn server:app` worker
+pointed at the stub. It then drives /n8n/chat and /api/chatkit/session at a
+fixed concurrency. Every --sample-interval it reads /debug/runtime and records
+RSS and event-loop lag. At the end of --warmup it resets the worker's
+allocator baseline and loop-lag counters, so the checks only cover the run
+under load. The tracemalloc top allocators are fetched once after the last
+sample: a snapshot leaves RSS tens of MB higher, which mid-run would look like
+growth. --tracemalloc-every N also fetches them every N samples, in a separate
+request so a slow snapshot does not hold up the regular samples. It fails if
+RSS kept growing after warm-up, loop lag since the reset crossed the threshold
+or the worker stopped answering.
+
+The debug endpoints need a token: a spawned worker gets a random one, an
+existing worker's is passed with --debug-token (or DEBUG_TOKEN).
+
+    python soak.py run --duration 4h
+    python soak.py run --duration 10m --concurrency 32 --stub-latency-ms 50 --out soak.jsonl
+    python soak.py run --worker-url http://127.0.0.1:8000 --debug-token ... --duration 1h   # existing worker
+    python soak.py stub --port 9100                                        # stub only
+
+Agents tracing export is off by default (OPENAI_AGENTS_DISABLE_TRACING=1)
+because the exporter posts to the real API. Pass --tracing to keep trace
+objects in the loop anyway.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, Optional
+
+import httpx
+from fastapi import FastAPI, Request
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STUB_LATENCY_MS = float(os.getenv("SOAK_STUB_LATENCY_MS", "20"))
+# Consecutive failed /debug/runtime reads before the worker counts as gone
+SAMPLE_ATTEMPTS = 3
+
+MESSAGES = [
+    "How do I reset my password?",
+    "I want to return my phone, it stopped charging.",
+    "Why haven't I received any surveys this week?",
+    "My reward voucher has not arrived after 10 days.",
+    "How does the referral code work?",
+    "Can I change my birthdate on my profile?",
+]
+
+
+# ----------------------------
+# Stub OpenAI API
+# ----------------------------
+stub_app = FastAPI()
+_stub_counter = {"n": 0}
+
+
+def _fake_from_schema(schema: dict, defs: Optional[dict] = None) -> Any:
+    """
+    Smallest value that satisfies a JSON schema well enough for the SDKs to parse.
+    """
+    defs = defs if defs is not None else (schema.get("$defs") or {})
+    if "$ref" in schema:
+        return _fake_from_schema(defs.get(schema["$ref"].rsplit("/", 1)[-1], {}), defs)
+    if "anyOf" in schema:
+        return _fake_from_schema(schema["anyOf"][0], defs)
+    if "enum" in schema:
+        return random.choice(schema["enum"])
+
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        value = {}
+        for name, prop in (schema.get("properties") or {}).items():
+            if name == "classification":
+                _stub_counter["n"] += 1
+                value[name] = ("get_information", "return_item")[_stub_counter["n"] % 2]
+            else:
+                value[name] = _fake_from_schema(prop, defs)
+        return value
+    return {"string": "ok", "boolean": False, "number": 0.0, "integer": 0, "array": []}.get(kind)
+
+
+def _fake_text(schema: Optional[dict]) -> str:
+    if schema is None:
+        return "Stub reply. " + " ".join(random.choices(MESSAGES, k=3))
+    return json.dumps(_fake_from_schema(schema))
+
+
+@stub_app.get("/v1/models")
+async def stub_models():
+    return {"object": "list", "data": [{"id": "gpt-4.1-mini", "object": "model", "created": 0, "owned_by": "stub"}]}
+
+
+@stub_app.post("/v1/responses")
+async def stub_responses(request: Request):
+    body = await request.json()
+    await asyncio.sleep(STUB_LATENCY_MS / 1000)
+    fmt = (body.get("text") or {}).get("format") or {}
+    text = _fake_text(fmt.get("schema") if fmt.get("type") == "json_schema" else None)
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model", "stub"),
+        "status": "completed",
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": 200,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": 20,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": 220,
+        },
+    }
+
+
+@stub_app.post("/v1/chat/completions")
+async def stub_chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(STUB_LATENCY_MS / 1000)
+    fmt = body.get("response_format") or {}
+    schema = (fmt.get("json_schema") or {}).get("schema") if fmt.get("type") == "json_schema" else None
+    if schema is None and fmt.get("type") == "json_object":
+        schema = {"type": "object", "properties": {"flagged": {"type": "boolean"}, "confidence": {"type": "number"}}}
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": _fake_text(schema), "refusal": None},
+            "finish_reason": "stop",
+            "logprobs": None,
+        }],
+        "usage": {"prompt_tokens": 150, "completion_tokens": 10, "total_tokens": 160},
+    }
+
+
+@stub_app.post("/v1/chatkit/sessions")
+async def stub_chatkit_sessions():
+    await asyncio.sleep(STUB_LATENCY_MS / 1000)
+    return {"id": f"cksess_{uuid.uuid4().hex}", "client_secret": f"ek_{uuid.uuid4().hex}"}
+
+
+@stub_app.post("/v1/traces/ingest")
+async def stub_traces():
+    return {}
+
+
+# ----------------------------
+# Processes
+# ----------------------------
+def _parse_duration(value: str) -> float:
+    units = {"s": 1, "m": 60, "h": 3600}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def _spawn(args: list[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", *args], cwd=HERE, env=env)
+
+
+async def _wait_for(client: httpx.AsyncClient, url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+# ----------------------------
+# Load + sampling
+# ----------------------------
+class LoadStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.by_endpoint: dict[str, int] = {}
+        self.last_error: Optional[str] = None
+
+
+async def _drive(client: httpx.AsyncClient, base: str, stats: LoadStats, chatkit_ratio: float, stop: asyncio.Event):
+    backoff = 0.0
+    while not stop.is_set():
+        if backoff:
+            # The worker is down or refusing connections; don't spin on it
+            await asyncio.sleep(backoff)
+        if random.random() < chatkit_ratio:
+            endpoint = "/api/chatkit/session"
+            payload = {"user_id": f"soak-{random.randint(1, 1000)}"}
+        else:
+            endpoint = "/n8n/chat"
+            payload = {"sessionId": uuid.uuid4().hex, "message": f"{random.choice(MESSAGES)} ({uuid.uuid4().hex[:8]})"}
+        stats.requests += 1
+        stats.by_endpoint[endpoint] = stats.by_endpoint.get(endpoint, 0) + 1
+        try:
+            resp = await client.post(f"{base}{endpoint}", json=payload)
+            backoff = 0.0
+            if resp.status_code != 200:
+                stats.errors += 1
+                stats.last_error = f"{endpoint} {resp.status_code}: {resp.text[:200]}"
+        except httpx.HTTPError as e:
+            stats.errors += 1
+            stats.last_error = f"{endpoint} {type(e).__name__}: {e}"
+            if isinstance(e, httpx.TransportError):
+                backoff = min(max(backoff * 2, 0.1), 5.0)
+
+
+async def _sample(client: httpx.AsyncClient, base: str, token: str, top: int = 0, reset_baseline: bool = False) -> dict:
+    params = {"top": top, "reset_baseline": "true" if reset_baseline else "false"}
+    # tracemalloc snapshots of a busy worker can take a minute or more
+    timeout = 600 if top or reset_baseline else 120
+    resp = await client.get(f"{base}/debug/runtime", params=params, headers={"X-Debug-Token": token}, timeout=timeout)
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def _sample_or_none(
+    client: httpx.AsyncClient, base: str, token: str, procs: list[subprocess.Popen]
+) -> tuple[Optional[dict], Optional[str]]:
+    """
+    A sample, or None and the reason once the worker has stopped answering.
+    """
+    error = None
+    for _ in range(SAMPLE_ATTEMPTS):
+        exited = [p for p in procs if p.poll() is not None]
+        if exited:
+            return None, f"{exited[0].args[3]} exited with code {exited[0].returncode}"
+        try:
+            return await _sample(client, base, token), None
+        except (httpx.HTTPError, ValueError) as e:
+            error = f"{type(e).__name__}: {e}"
+            await asyncio.sleep(1)
+    return None, f"/debug/runtime failed {SAMPLE_ATTEMPTS} times ({error})"
+
+
+def evaluate(samples: list[dict], max_rss_growth_mb: float, max_loop_lag_ms: float) -> list[str]:
+    """
+    Failure reasons; empty means the soak passed. Only samples taken after the
+    warm-up reset ("steady") count.
+    """
+    failures = []
+    steady = [s for s in samples if s.get("steady")]
+    if len(steady) < 3:
+        return [f"only {len(steady)} samples after warm-up; run longer or sample more often"]
+
+    rss = [s["rss_mb"] for s in steady if s["rss_mb"] is not None]
+    if len(rss) >= 3:
+        third = max(1, len(rss) // 3)
+        growth = statistics.median(rss[-third:]) - statistics.median(rss[:third])
+        xs = [s["elapsed_s"] / 3600 for s in steady if s["rss_mb"] is not None]
+        x_mean, y_mean = statistics.fmean(xs), statistics.fmean(rss)
+        denom = sum((x - x_mean) ** 2 for x in xs) or 1.0
+        slope = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, rss)) / denom
+        if growth > max_rss_growth_mb and slope > 0:
+            failures.append(f"RSS grew {growth:.1f} MB after warm-up (trend {slope:.1f} MB/h)")
+
+    # max since the reset, not a rolling window that could still hold warm-up stalls
+    worst = max(s["loop_lag_max_ms"] or 0 for s in steady)
+    if worst > max_loop_lag_ms:
+        failures.append(f"event loop lag reached {worst:.0f} ms (limit {max_loop_lag_ms:.0f} ms)")
+    return failures
+
+
+async def run(args) -> int:
+    duration = _parse_duration(args.duration)
+    warmup = _parse_duration(args.warmup)
+    procs: list[subprocess.Popen] = []
+    ledger_dir: Optional[str] = None
+    base = args.worker_url
+    token = args.debug_token if base else secrets.token_hex(16)
+    if not token:
+        print("ERROR: --worker-url needs --debug-token (or DEBUG_TOKEN) to read /debug/runtime")
+        return 2
+
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=args.concurrency + 4)) as client:
+        try:
+            if base is None:
+                env = {
+                    **os.environ,
+                    "SOAK_STUB_LATENCY_MS": str(args.stub_latency_ms),
+                }
+                procs.append(_spawn(["soak:stub_app", "--port", str(args.stub_port), "--log-level", "warning"], env))
+                await _wait_for(client, f"http://127.0.0.1:{args.stub_port}/v1/models", 30)
+
+                ledger_dir = tempfile.mkdtemp(prefix="soak-")
+                env.update({
+                    "OPENAI_BASE_URL": f"http://127.0.0.1:{args.stub_port}/v1",
+                    "OPENAI_API_KEY": "sk-soak",
+                    "CHATKIT_WORKFLOW_ID": "wf_soak",
+                    "DEBUG_TRACEMALLOC": str(args.tracemalloc_frames),
+                    "DEBUG_TOKEN": token,
+                    "USAGE_LEDGER_PATH": os.path.join(ledger_dir, "usage_ledger.jsonl"),
+                })
+                if not args.tracing:
+                    env["OPENAI_AGENTS_DISABLE_TRACING"] = "1"
+                procs.append(_spawn(["server:app", "--port", str(args.worker_port), "--log-level", "warning"], env))
+                base = f"http://127.0.0.1:{args.worker_port}"
+
+            await _wait_for(client, f"{base}/readyz", 300)
+            print(f"Soaking {base} for {duration:.0f}s at concurrency {args.concurrency}")
+
+            stats = LoadStats()
+            stop = asyncio.Event()
+            drivers = [
+                asyncio.create_task(_drive(client, base, stats, args.chatkit_ratio, stop))
+                for _ in range(args.concurrency)
+            ]
+
+            samples = []
+            allocations = []
+            worker_failure = None
+            # The warm-up reset and allocator dumps run beside the regular samples
+            reset_task: Optional[asyncio.Task] = None
+            top_task: Optional[asyncio.Task] = None
+            top_elapsed = 0.0
+            out = open(args.out, "w", encoding="utf-8") if args.out else None
+
+            def _write(record: dict) -> None:
+                if out is not None:
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+
+            def _collect_top(task: asyncio.Task, elapsed: float) -> None:
+                try:
+                    tm = task.result().get("tracemalloc")
+                except Exception as e:
+                    print(f"WARNING: tracemalloc sample failed: {type(e).__name__}: {e}")
+                    return
+                if tm:
+                    allocations.append({"elapsed_s": round(elapsed, 1), "tracemalloc": tm})
+                    _write(allocations[-1])
+
+            started = time.monotonic()
+            n = 0
+            try:
+                while True:
+                    elapsed = time.monotonic() - started
+                    if reset_task is not None and reset_task.done() and reset_task.exception() is not None:
+                        print(f"WARNING: baseline reset failed, retrying: {reset_task.exception()!r}")
+                        reset_task = None
+                    if reset_task is None and elapsed >= warmup:
+                        reset_task = asyncio.create_task(_sample(client, base, token, reset_baseline=True))
+                    # Counts only once the reset has gone through
+                    steady = reset_task is not None and reset_task.done() and reset_task.exception() is None
+                    if top_task is not None and top_task.done():
+                        _collect_top(top_task, top_elapsed)
+                        top_task = None
+                    if args.tracemalloc_every and n % args.tracemalloc_every == 0 and top_task is None:
+                        top_task = asyncio.create_task(_sample(client, base, token, top=args.top))
+                        top_elapsed = elapsed
+
+                    runtime, worker_failure = await _sample_or_none(client, base, token, procs)
+                    if runtime is None:
+                        print(f"ERROR: worker stopped answering: {worker_failure}")
+                        break
+                    lag = runtime["loop_lag"]
+                    sample = {
+                        "elapsed_s": round(elapsed, 1),
+                        "steady": steady,
+                        "requests": stats.requests,
+                        "errors": stats.errors,
+                        "rss_mb": round(runtime["rss_bytes"] / 2**20, 1) if runtime.get("rss_bytes") else None,
+                        # since the last reset
+                        "loop_lag_max_ms": lag["max_ms"],
+                        "loop_lag_recent_max_ms": lag["recent_max_ms"],
+                        "loop_lag_p99_ms": lag["recent_p99_ms"],
+                        "stalls": lag["stalls"],
+                        # lag while tracemalloc snapshots were taken; not in the numbers above
+                        "capture_lag_max_ms": lag.get("capture_max_ms"),
+                        "asyncio_tasks": runtime["asyncio_tasks"],
+                    }
+                    samples.append(sample)
+                    _write(sample)
+                    print(
+                        f"[{elapsed:>8.0f}s] req={stats.requests} err={stats.errors} rss={sample['rss_mb']}MB "
+                        f"lag_max={sample['loop_lag_max_ms']}ms stalls={sample['stalls']} tasks={sample['asyncio_tasks']}"
+                        + ("" if steady else " (warm-up)")
+                    )
+                    n += 1
+                    if elapsed >= duration:
+                        break
+                    # Keep to the schedule even when a sample was slow
+                    next_at = started + min(n * args.sample_interval, duration)
+                    await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+                if worker_failure is None and args.top > 0:
+                    # After the last sample, so the snapshot cannot skew it
+                    if top_task is not None:
+                        await asyncio.gather(top_task, return_exceptions=True)
+                        _collect_top(top_task, top_elapsed)
+                    top_task = asyncio.create_task(_sample(client, base, token, top=args.top))
+                    top_elapsed = time.monotonic() - started
+                    await asyncio.gather(top_task, return_exceptions=True)
+            finally:
+                stop.set()
+                await asyncio.gather(*drivers, return_exceptions=True)
+                for task in (reset_task, top_task):
+                    if task is not None and not task.done():
+                        task.cancel()
+                if top_task is not None and top_task.done() and not top_task.cancelled():
+                    _collect_top(top_task, top_elapsed)
+                if out is not None:
+                    out.close()
+
+            failures = evaluate(samples, args.max_rss_growth_mb, args.max_loop_lag_ms)
+            if worker_failure is not None:
+                failures.append(f"worker stopped answering after {samples[-1]['elapsed_s'] if samples else 0}s: {worker_failure}")
+            error_rate = stats.errors / stats.requests if stats.requests else 0.0
+            if error_rate > args.max_error_rate:
+                failures.append(f"error rate {error_rate:.2%} (last: {stats.last_error})")
+
+            last_top = allocations[-1]["tracemalloc"] if allocations else None
+            if last_top and last_top.get("top_growth"):
+                print("Top allocation growth since " + ("warm-up:" if any(s["steady"] for s in samples) else "worker ready:"))
+                for row in last_top["top_growth"][:args.top]:
+                    print(f"  {row['size_diff_kb']:>10.1f} kB  {row['count_diff']:>8}  {row['where']}")
+
+            print(json.dumps({"requests": stats.requests, "by_endpoint": stats.by_endpoint,
+                              "errors": stats.errors, "failures": failures}, indent=2))
+            return 1 if failures else 0
+        finally:
+            for proc in reversed(procs):
+                proc.terminate()
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            if ledger_dir is not None:
+                shutil.rmtree(ledger_dir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="soak a worker")
+    p_run.add_argument("--duration", default="1h", help="e.g. 600, 30m, 4h")
+    p_run.add_argument("--warmup", default="5m", help="ignored for growth/lag checks; ends with a baseline reset")
+    p_run.add_argument("--concurrency", type=int, default=16)
+    p_run.add_argument("--chatkit-ratio", type=float, default=0.2, help="share of requests to /api/chatkit/session")
+    p_run.add_argument("--sample-interval", type=float, default=30.0, help="seconds between /debug/runtime samples")
+    p_run.add_argument("--tracemalloc-every", type=int, default=0,
+                       help="also fetch allocators every N samples (inflates RSS); 0 only at the end")
+    p_run.add_argument("--tracemalloc-frames", type=int, default=1, help="DEBUG_TRACEMALLOC for the spawned worker")
+    p_run.add_argument("--top", type=int, default=10, help="allocation sites to report, 0 skips tracemalloc")
+    p_run.add_argument("--max-rss-growth-mb", type=float, default=50.0)
+    p_run.add_argument("--max-loop-lag-ms", type=float, default=500.0)
+    p_run.add_argument("--max-error-rate", type=float, default=0.01)
+    p_run.add_argument("--stub-latency-ms", type=float, default=STUB_LATENCY_MS)
+    p_run.add_argument("--stub-port", type=int, default=9100)
+    p_run.add_argument("--worker-port", type=int, default=9101)
+    p_run.add_argument("--worker-url", help="soak an already running worker instead of spawning one")
+    p_run.add_argument("--debug-token", default=os.getenv("DEBUG_TOKEN"), help="X-Debug-Token for --worker-url")
+    p_run.add_argument("--tracing", action="store_true", help="leave agents tracing export enabled")
+    p_run.add_argument("--out", help="write samples as JSONL")
+
+    p_stub = sub.add_parser("stub", help="serve only the stub OpenAI API")
+    p_stub.add_argument("--port", type=int, default=9100)
+
+    args = parser.parse_args()
+    if args.command == "stub":
+        import uvicorn
+        uvicorn.run(stub_app, host="127.0.0.1", port=args.port, log_level="warning")
+        return
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
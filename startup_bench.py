@@ -0,0 +1,107 @@
+# startup_bench.py
+"""
+Cold-start benchmark for a worker.
+
+Each run happens in a fresh interpreter. It times the same import sequence the
+server's warm-up uses, one package at a time, then the workflow registry warm-up.
+It also reports the heaviest transitive imports from `python -X importtime`.
+
+    python startup_bench.py                 # 5 runs, median per step
+    python startup_bench.py --runs 10 --top 25
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from server import WARMUP_IMPORTS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# Executed in the child interpreter; prints one JSON line with timings in ms
+_CHILD = """
+import importlib, json, os, time
+from dotenv import load_dotenv
+load_dotenv()
+os.environ.setdefault("DEFER_PYDANTIC_BUILD", "false")  # as server.py
+timings = {}
+for name in %r:
+    t0 = time.perf_counter()
+    importlib.import_module(name)
+    timings["import " + name] = (time.perf_counter() - t0) * 1000
+import workflow_registry
+for step, ms in workflow_registry.warm_up().items():
+    timings["warm " + step] = ms
+print(json.dumps(timings))
+"""
+
+
+def run_once() -> dict[str, float]:
+    proc = subprocess.run(
+        [sys.executable, "-c", _CHILD % (WARMUP_IMPORTS,)],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=HERE,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def importtime_top(top: int) -> list[tuple[int, int, str]]:
+    """
+    (self_us, cumulative_us, module) for the slowest imports under workflow_registry.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "from dotenv import load_dotenv; load_dotenv(); import workflow_registry"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=HERE,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+            rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+        except ValueError:
+            continue
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return rows[:top]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest transitive imports to list")
+    args = parser.parse_args()
+
+    samples: dict[str, list[float]] = {}
+    for _ in range(args.runs):
+        for step, ms in run_once().items():
+            samples.setdefault(step, []).append(ms)
+
+    print(f"Startup breakdown over {args.runs} cold run(s) (ms)")
+    print(f"{'step':<32}{'median':>10}{'min':>10}{'max':>10}")
+    total = 0.0
+    for step, values in samples.items():
+        median = statistics.median(values)
+        total += median
+        print(f"{step:<32}{median:>10.1f}{min(values):>10.1f}{max(values):>10.1f}")
+    print(f"{'total':<32}{total:>10.1f}")
+
+    print()
+    print(f"Slowest transitive imports (-X importtime, top {args.top})")
+    print(f"{'cumulative ms':>14}{'self ms':>10}  module")
+    for self_us, cumulative_us, name in importtime_top(args.top):
+        print(f"{cumulative_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The app is a set of top-level modules, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# agent_workflow builds the shared AsyncOpenAI client at import; no request is ever sent
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
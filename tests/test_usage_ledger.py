@@ -0,0 +1,56 @@
+import json
+import os
+
+from usage_ledger import UsageLedger, ledger_files, process_path
+
+
+def read(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["n"] for line in f]
+
+
+def test_process_path_adds_pid():
+    assert process_path("logs/usage.jsonl", pid=42) == "logs/usage-42.jsonl"
+
+
+def test_rotation_across_batches_keeps_recent_records_in_order(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.jsonl"), max_bytes=100, backups=2, max_total_bytes=0)
+    for n in range(20):
+        ledger._write([{"n": n, "pad": "x" * 20}])
+
+    files = [f"{ledger.path}.2", f"{ledger.path}.1", ledger.path]
+    assert sorted(ledger_files(ledger.base_path)) == sorted(files)
+    assert all(os.path.getsize(p) <= 100 for p in files)
+    # Oldest backup first, live file last: a contiguous run ending at the newest record
+    seen = [n for p in files for n in read(p)]
+    assert seen == list(range(seen[0], 20))
+    assert not os.path.exists(f"{ledger.path}.3")
+
+
+def test_writer_thread_flushes_on_close(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.jsonl"), flush_interval=0.05, max_total_bytes=0)
+    ledger.start()
+    for n in range(1200):
+        ledger.append({"n": n})
+    ledger.close()
+
+    assert read(ledger.path) == list(range(1200))
+    assert ledger.stats()["written"] == 1200
+
+
+def test_start_prunes_oldest_files_of_other_processes(tmp_path):
+    base = str(tmp_path / "usage.jsonl")
+    ledger = UsageLedger(base, max_total_bytes=250)
+    own = process_path(base)
+    for i, path in enumerate([process_path(base, 1) + ".1", process_path(base, 1), process_path(base, 2), own]):
+        with open(path, "w") as f:
+            f.write("x" * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+    unrelated = tmp_path / "usage-notes.jsonl"
+    unrelated.write_text("x" * 1000)
+
+    ledger.start()
+    ledger.close()
+
+    assert ledger_files(base) == sorted([process_path(base, 2), own])
+    assert unrelated.exists()
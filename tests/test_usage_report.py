@@ -0,0 +1,79 @@
+import random
+
+from usage_report import Histogram, aggregate
+
+
+PRICES = {"gpt-4.1-mini": (0.40, 0.10, 1.60), "gpt-5-nano": (0.05, 0.005, 0.40)}
+
+
+def test_histogram_percentiles_within_bucket_error():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(6, 1) for _ in range(20000)]
+    h = Histogram()
+    for v in values:
+        h.add(v)
+
+    values.sort()
+    for p in (50, 90, 99):
+        exact = values[int(len(values) * p / 100) - 1]
+        assert abs(h.percentile(p) - exact) / exact < 0.03
+    assert h.max == values[-1]
+    assert h.percentile(100) <= h.max
+    assert h.count == len(values)
+
+
+def test_histogram_small_and_empty():
+    h = Histogram()
+    assert h.percentile(50) is None
+    h.add(0.2)
+    h.add(0.7)
+    assert h.percentile(99) == 0.7
+
+
+def record(branch, total, agents, ok=True, ts=1760000000):
+    return {"ts": ts, "branch": branch, "ok": ok, "stages": {"total": total}, "agents": agents,
+            "workflow": "milieu", "version": "abc"}
+
+
+def agent(model, ms, tokens_in=1000, tokens_out=100, cached=0):
+    return {"agent": "a", "model": model, "ms": ms, "req": 1, "in": tokens_in, "out": tokens_out, "cached": cached}
+
+
+def test_aggregate_groups_by_branch_and_by_model():
+    records = [
+        record("get_information", 300, [agent("gpt-5-nano", 50), agent("gpt-4.1-mini", 200, cached=400)]),
+        record("get_information", 500, [agent("gpt-5-nano", 60), agent("gpt-4.1-mini", 400)]),
+        record(None, 80, [agent("gpt-5-nano", 70)], ok=False),
+    ]
+    result = aggregate(records, ["branch", "model"], PRICES)
+
+    branch = {k: g.row() for k, g in result["branch"].items()}
+    assert set(branch) == {"get_information", "error"}
+    assert branch["get_information"]["requests"] == 2
+    assert branch["get_information"]["max_ms"] == 500
+    assert branch["get_information"]["input_tokens"] == 4000
+    assert branch["error"]["errors"] == 1
+
+    # Model groups count agent calls and use per-call latency
+    model = {k: g.row() for k, g in result["model"].items()}
+    assert model["gpt-5-nano"]["requests"] == 3
+    assert model["gpt-5-nano"]["max_ms"] == 70
+    assert model["gpt-4.1-mini"]["requests"] == 2
+    assert model["gpt-4.1-mini"]["cached_tokens"] == 400
+    expected = ((2000 - 400) * 0.40 + 400 * 0.10 + 200 * 1.60) / 1_000_000
+    assert abs(model["gpt-4.1-mini"]["cost_usd"] - expected) < 1e-9
+
+    # Both views account for the same tokens and cost
+    assert sum(r["output_tokens"] for r in branch.values()) == sum(r["output_tokens"] for r in model.values())
+    assert abs(sum(r["cost_usd"] for r in branch.values()) - sum(r["cost_usd"] for r in model.values())) < 1e-6
+
+
+def test_aggregate_hour_window_and_unpriced_models():
+    records = [
+        record("a", 100, [agent("mystery-model", 10)], ts=1760000000),
+        record("a", 100, [], ts=1760000000 + 7200),
+    ]
+    result = aggregate(records, ["hour", "model"], PRICES, since="2025-10-09T08", until="2025-10-09T10")
+
+    assert list(result["hour"]) == ["2025-10-09T08"]
+    assert result["model"]["mystery-model"].row()["unpriced_tokens"] == 1100
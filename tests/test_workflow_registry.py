@@ -0,0 +1,147 @@
+import json
+import os
+import time
+
+import pytest
+
+pytest.importorskip("agents")
+pytest.importorskip("guardrails.runtime")
+
+from workflow_registry import WorkflowNotFound, WorkflowRegistry  # noqa: E402
+
+
+def definition(workflow_id, instructions="Answer briefly."):
+    return {
+        "id": workflow_id,
+        "trace_name": "Test",
+        "trace_workflow_id": "wf_test",
+        "agents": {
+            "classification": {
+                "name": "Classification agent",
+                "instructions": "Classify.",
+                "model": "gpt-4.1-mini",
+                "output_schema": {"classification": "str"},
+            },
+            "information": {"name": "Information agent", "instructions": instructions, "model": "gpt-4.1-mini"},
+        },
+        "routing": {
+            "classifier": "classification",
+            "routes": {"get_information": {"agent": "information"}},
+        },
+    }
+
+
+def write(path, content, bump=0):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content if isinstance(content, str) else json.dumps(content))
+    # mtime resolution can be coarser than the test; set distinct mtimes explicitly
+    mtime = time.time() - 1000 + bump
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def registry(tmp_path):
+    write(tmp_path / "main.json", definition("main"))
+    write(tmp_path / "other.json", definition("other"))
+    reg = WorkflowRegistry(str(tmp_path), default_id="main")
+    reg.load(force=True)
+    return reg
+
+
+def test_unchanged_reload_is_a_noop(registry):
+    assert registry.load() == []
+    assert {w["id"] for w in registry.list()} == {"main", "other"}
+
+
+def test_edit_swaps_version_and_keeps_old_object(registry, tmp_path):
+    old = registry.get("main")
+    write(tmp_path / "main.json", definition("main", "Answer at length."), bump=10)
+
+    assert registry.load() == ["main"]
+    new = registry.get("main")
+    assert new is not old
+    assert new.version != old.version
+    assert old.agents["information"].instructions == "Answer briefly."
+    assert new.agents["information"].instructions == "Answer at length."
+
+
+def test_removed_file_unregisters_workflow(registry, tmp_path):
+    os.remove(tmp_path / "other.json")
+
+    assert registry.load() == ["other (removed)"]
+    with pytest.raises(WorkflowNotFound):
+        registry.get("other")
+
+
+def test_id_change_drops_previous_id(registry, tmp_path):
+    write(tmp_path / "other.json", definition("renamed"), bump=10)
+
+    assert sorted(registry.load()) == ["other (removed)", "renamed"]
+    assert registry.get("renamed").id == "renamed"
+    with pytest.raises(WorkflowNotFound):
+        registry.get("other")
+
+
+def test_bad_file_keeps_previous_version_and_reports_once(registry, tmp_path, capsys):
+    old = registry.get("other")
+    write(tmp_path / "other.json", "{not json", bump=10)
+
+    assert registry.load() == []
+    assert registry.load() == []
+    assert capsys.readouterr().out.count("ERROR loading workflow") == 1
+    assert registry.get("other") is old
+
+    write(tmp_path / "other.json", definition("other", "Fixed."), bump=20)
+    assert registry.load() == ["other"]
+    assert registry.get("other").agents["information"].instructions == "Fixed."
+
+
+def test_future_mtime_is_not_rebuilt_every_poll(registry, tmp_path):
+    write(tmp_path / "main.json", definition("main", "Answer at length."), bump=10 ** 6)
+
+    assert registry.load() == ["main"]
+    assert registry.load() == []
+
+
+def test_touch_without_change_keeps_running_version(registry, tmp_path):
+    old = registry.get("main")
+    write(tmp_path / "main.json", definition("main"), bump=10)
+
+    assert registry.load() == []
+    assert registry.get("main") is old
+
+
+def test_new_definition_loads_once_its_prompt_file_appears(registry, tmp_path):
+    spec = definition("new")
+    spec["agents"]["information"]["instructions_file"] = "p.md"
+    write(tmp_path / "new.json", spec, bump=10)
+
+    assert registry.load() == []
+    with pytest.raises(WorkflowNotFound):
+        registry.get("new")
+
+    write(tmp_path / "p.md", "From the prompt file.", bump=20)
+    assert registry.load() == ["new"]
+    assert registry.get("new").agents["information"].instructions == "From the prompt file."
+
+
+def test_startup_skips_bad_secondary_file(tmp_path):
+    write(tmp_path / "main.json", definition("main"))
+    write(tmp_path / "broken.json", "{not json")
+    reg = WorkflowRegistry(str(tmp_path), default_id="main")
+
+    reg.load(force=True)
+    assert [w["id"] for w in reg.list()] == ["main"]
+
+    # Fixing the file later is picked up by the normal reload
+    write(tmp_path / "broken.json", definition("broken"), bump=10)
+    assert reg.load() == ["broken"]
+
+
+def test_startup_fails_without_default(tmp_path):
+    write(tmp_path / "main.json", "{not json")
+    write(tmp_path / "other.json", definition("other"))
+    reg = WorkflowRegistry(str(tmp_path), default_id="main")
+
+    with pytest.raises(WorkflowNotFound):
+        reg.load(force=True)
@@ -0,0 +1,231 @@
+# usage_ledger.py
+"""
+Append-only, size-rotated JSONL ledger with one compact record per request.
+
+`append()` only puts the record on a queue, so it never blocks the event loop.
+A daemon thread drains the queue in batches and writes each batch in one call.
+When the file passes USAGE_LEDGER_MAX_BYTES it is rotated like
+logging.handlers.RotatingFileHandler (.1, .2, ...).
+
+Rotation needs a single writer, so each process writes its own file: with
+USAGE_LEDGER_PATH=usage_ledger.jsonl a worker with pid 4242 writes
+usage_ledger-4242.jsonl. usage_report.py reads all of them. Every restart
+brings a new pid, so on start() the oldest files of other processes are
+deleted until all ledger files together fit in USAGE_LEDGER_MAX_TOTAL_BYTES.
+
+Record shape:
+    {"ts": 1760000000.1, "session": "...", "workflow": "milieu", "version": "2752534f7013",
+     "branch": "get_information", "tripwire": false, "ok": true, "cache": "hit",
+     "stages": {"guardrails": 310.2, "classify": 820.4, "route": 2400.9, "total": 3540.0},
+     "agents": [{"agent": "classification", "model": "gpt-4.1-mini", "ms": 820.4,
+                 "req": 1, "in": 180, "out": 9, "cached": 0},
+                {"agent": "guardrail:Jailbreak", "model": "gpt-5-nano", ...}, ...]}
+
+Settings (env):
+    USAGE_LEDGER_PATH            base file name, pid is added; empty disables (default ./usage_ledger.jsonl)
+    USAGE_LEDGER_MAX_BYTES       rotate above this size (default 50 MB)
+    USAGE_LEDGER_BACKUPS         rotated files kept (default 5)
+    USAGE_LEDGER_MAX_TOTAL_BYTES cap on all processes' files together, 0 disables (default 1 GB)
+    USAGE_LEDGER_FLUSH_INTERVAL  max seconds a record waits in the buffer (default 1)
+"""
+from __future__ import annotations
+
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+from typing import Optional
+
+
+USAGE_LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", "usage_ledger.jsonl")
+USAGE_LEDGER_MAX_BYTES = int(os.getenv("USAGE_LEDGER_MAX_BYTES", str(50 * 1024 * 1024)))
+USAGE_LEDGER_BACKUPS = int(os.getenv("USAGE_LEDGER_BACKUPS", "5"))
+USAGE_LEDGER_MAX_TOTAL_BYTES = int(os.getenv("USAGE_LEDGER_MAX_TOTAL_BYTES", str(1024 * 1024 * 1024)))
+USAGE_LEDGER_FLUSH_INTERVAL = float(os.getenv("USAGE_LEDGER_FLUSH_INTERVAL", "1"))
+
+# Records beyond this are dropped (and counted) rather than growing memory
+_QUEUE_SIZE = 10000
+_BATCH_SIZE = 500
+
+
+def process_path(path: str, pid: Optional[int] = None) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}-{pid if pid is not None else os.getpid()}{ext}"
+
+
+def ledger_files(path: str) -> list[str]:
+    """
+    Every process's ledger for a base path, rotated files included.
+    """
+    root, ext = os.path.splitext(path)
+    name = re.compile(re.escape(os.path.basename(root)) + r"-\d+" + re.escape(ext) + r"(\.\d+)?$")
+    candidates = glob.glob(f"{glob.escape(root)}-*{ext}*")
+    return sorted(p for p in candidates if name.match(os.path.basename(p)))
+
+
+def cache_outcome(agents: list[dict]) -> str:
+    """
+    "hit" if any prompt tokens were served from the prompt cache, "miss" if none, "none" if no LLM call.
+    """
+    if not agents:
+        return "none"
+    return "hit" if any(a.get("cached") for a in agents) else "miss"
+
+
+class UsageLedger:
+    def __init__(
+        self,
+        base_path: str,
+        max_bytes: int = USAGE_LEDGER_MAX_BYTES,
+        backups: int = USAGE_LEDGER_BACKUPS,
+        flush_interval: float = USAGE_LEDGER_FLUSH_INTERVAL,
+        max_total_bytes: int = USAGE_LEDGER_MAX_TOTAL_BYTES,
+    ):
+        self.base_path = base_path
+        self.path = process_path(base_path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_total_bytes = max_total_bytes
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        if self._thread is None:
+            # Resolved here, in the process that will write
+            self.path = process_path(self.base_path)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            try:
+                self._prune()
+            except Exception as e:
+                print("ERROR pruning usage ledger files:", e)
+            self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+            self._thread.start()
+
+    def append(self, record: dict) -> None:
+        """
+        Non-blocking; safe to call from the event loop.
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Flush what is buffered and stop the writer thread.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _prune(self) -> None:
+        """
+        Delete the oldest files of other (e.g. restarted) processes until all
+        ledger files fit in max_total_bytes. Our own files are left to rotation.
+        """
+        if self.max_total_bytes <= 0:
+            return
+        total = 0
+        others = []
+        for p in ledger_files(self.base_path):
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            total += st.st_size
+            if p != self.path and not p.startswith(self.path + "."):
+                others.append((st.st_mtime, st.st_size, p))
+        for _, size, p in sorted(others):
+            if total <= self.max_total_bytes:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+
+    def _drain(self) -> list[dict]:
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < _BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._drain()
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Never let ledger problems take the worker down
+                print("ERROR writing usage ledger:", e)
+
+    def _write(self, batch: list[dict]) -> None:
+        data = "".join(json.dumps(r, separators=(",", ":"), default=str) + "\n" for r in batch)
+        self._maybe_rotate(len(data))
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+        self.written += len(batch)
+
+    def _maybe_rotate(self, incoming: int) -> None:
+        if self.max_bytes <= 0:
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size + incoming <= self.max_bytes:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+ledger: Optional[UsageLedger] = UsageLedger(USAGE_LEDGER_PATH) if USAGE_LEDGER_PATH else None
+
+
+def new_record(session: Optional[str]) -> dict:
+    return {"ts": round(time.time(), 3), "session": session}
+
+
+def finish_record(record: dict, ok: bool, started: float) -> None:
+    """
+    Stamp the outcome and total time, then hand the record to the writer.
+    """
+    if ledger is None:
+        return
+    record["ok"] = ok
+    record.setdefault("stages", {})["total"] = round((time.perf_counter() - started) * 1000, 1)
+    record["cache"] = cache_outcome(record.get("agents") or [])
+    ledger.append(record)
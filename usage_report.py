@@ -0,0 +1,236 @@
+# usage_report.py
+"""
+Latency and cost breakdowns from the usage ledger (see usage_ledger.py).
+
+The ledger is read line by line and never loaded whole. Percentiles come from
+log-spaced histograms (about 2% relative error), so memory depends on the
+number of groups, not the number of records.
+
+    python usage_report.py                              # every worker's ledger + rotated files
+    python usage_report.py logs/ledger.jsonl* --by branch --by model
+    python usage_report.py --prices prices.json --since 2026-10-01T00 --json
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import gzip
+import json
+import math
+import sys
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from usage_ledger import USAGE_LEDGER_PATH, ledger_files
+
+
+# USD per 1M tokens: (input, cached input, output). Override with --prices.
+DEFAULT_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-5": (1.25, 0.125, 10.00),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+}
+
+PERCENTILES = (50, 90, 99)
+
+
+# ----------------------------
+# Streaming aggregation
+# ----------------------------
+class Histogram:
+    """
+    Log-bucketed latency histogram; percentiles are accurate to about half a bucket (~2%).
+    """
+
+    _BASE = 1.04
+
+    def __init__(self):
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        idx = int(math.log(value, self._BASE)) if value > 1 else 0
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= rank:
+                # Geometric midpoint of the bucket, capped at the true maximum
+                return min(self._BASE ** (idx + 0.5) if idx else 1.0, self.max)
+        return self.max
+
+
+class Group:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+        self.unpriced_tokens = 0
+
+    def add_tokens(self, agent: dict, prices: dict) -> None:
+        tokens_in = agent.get("in") or 0
+        cached = agent.get("cached") or 0
+        tokens_out = agent.get("out") or 0
+        self.input_tokens += tokens_in
+        self.cached_tokens += cached
+        self.output_tokens += tokens_out
+        price = prices.get(agent.get("model"))
+        if price is None:
+            self.unpriced_tokens += tokens_in + tokens_out
+            return
+        p_in, p_cached, p_out = price
+        self.cost += ((tokens_in - cached) * p_in + cached * p_cached + tokens_out * p_out) / 1_000_000
+
+    def row(self) -> dict:
+        row = {"requests": self.requests, "errors": self.errors}
+        for p in PERCENTILES:
+            value = self.latency.percentile(p)
+            row[f"p{p}_ms"] = round(value, 1) if value is not None else None
+        row["max_ms"] = round(self.latency.max, 1)
+        row.update({
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "cost_usd": round(self.cost, 6),
+        })
+        if self.unpriced_tokens:
+            row["unpriced_tokens"] = self.unpriced_tokens
+        return row
+
+
+def _hour(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H")
+
+
+def iter_records(paths: list[str]) -> Iterator[dict]:
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a crashed worker
+                    continue
+
+
+def aggregate(records, dimensions: list[str], prices: dict, since: Optional[str] = None, until: Optional[str] = None):
+    """
+    One pass over the records. Returns {dimension: {key: Group}}.
+
+    Branch and hour groups use request latency. Model groups use per-agent-call
+    latency and count agent calls as "requests".
+    """
+    result: dict[str, dict[str, Group]] = {d: {} for d in dimensions}
+    for record in records:
+        ts = record.get("ts") or 0
+        hour = _hour(ts)
+        if (since and hour < since) or (until and hour >= until):
+            continue
+
+        agents = record.get("agents") or []
+        total_ms = (record.get("stages") or {}).get("total")
+        keys = {
+            "branch": record.get("branch") or ("error" if not record.get("ok", True) else "unknown"),
+            "hour": hour,
+            "workflow": f"{record.get('workflow')}@{record.get('version')}",
+        }
+
+        for dim in dimensions:
+            groups = result[dim]
+            if dim == "model":
+                for agent in agents:
+                    g = groups.setdefault(agent.get("model") or "unknown", Group())
+                    g.requests += 1
+                    if agent.get("ms") is not None:
+                        g.latency.add(agent["ms"])
+                    g.add_tokens(agent, prices)
+                continue
+
+            g = groups.setdefault(keys[dim], Group())
+            g.requests += 1
+            if not record.get("ok", True):
+                g.errors += 1
+            if total_ms is not None:
+                g.latency.add(total_ms)
+            for agent in agents:
+                g.add_tokens(agent, prices)
+    return result
+
+
+# ----------------------------
+# Output
+# ----------------------------
+_COLUMNS = ("requests", "errors", "p50_ms", "p90_ms", "p99_ms", "max_ms",
+            "input_tokens", "cached_tokens", "output_tokens", "cost_usd")
+
+
+def print_table(dimension: str, groups: dict[str, Group]) -> None:
+    print(f"== by {dimension} ==")
+    width = max([len(dimension), *(len(k) for k in groups)]) + 2
+    print(f"{dimension:<{width}}" + "".join(f"{c:>15}" for c in _COLUMNS))
+    for key in sorted(groups):
+        row = groups[key].row()
+        cells = []
+        for c in _COLUMNS:
+            v = row.get(c)
+            cells.append(f"{'-' if v is None else v:>15}")
+        print(f"{key:<{width}}" + "".join(cells))
+    print()
+
+
+def default_paths() -> list[str]:
+    # One ledger per worker process (see usage_ledger.process_path), plus rotated files
+    return ledger_files(USAGE_LEDGER_PATH)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="ledger files (.jsonl or .jsonl.gz); default: the configured ledger")
+    parser.add_argument("--by", action="append", choices=("branch", "model", "hour", "workflow"),
+                        help="breakdown(s) to print; repeatable (default: branch, model, hour)")
+    parser.add_argument("--prices", help='JSON file {"model": [input, cached_input, output]} in USD per 1M tokens')
+    parser.add_argument("--since", help="UTC hour, inclusive, e.g. 2026-10-01T00")
+    parser.add_argument("--until", help="UTC hour, exclusive")
+    parser.add_argument("--json", action="store_true", help="emit JSON instead of tables")
+    args = parser.parse_args()
+
+    prices = dict(DEFAULT_PRICES)
+    if args.prices:
+        with open(args.prices, encoding="utf-8") as f:
+            prices.update({k: tuple(v) for k, v in json.load(f).items()})
+
+    paths = [p for p in (args.paths or default_paths()) if glob.glob(p)]
+    if not paths:
+        sys.exit("No ledger files found")
+
+    dimensions = args.by or ["branch", "model", "hour"]
+    result = aggregate(iter_records(paths), dimensions, prices, args.since, args.until)
+
+    if args.json:
+        print(json.dumps({d: {k: g.row() for k, g in groups.items()} for d, groups in result.items()}, indent=2))
+        return
+    for dim in dimensions:
+        print_table(dim, result[dim])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# workflow_registry.py
+"""
+File-backed registry of workflow definitions.
+
+Each `workflows/<id>.json` describes one workflow: its agents (model,
+instructions, settings, tools), guardrail config and classification routing.
+A definition is built once into a `BuiltWorkflow` (Agent objects, instantiated
+guardrails, RunConfig) and requests pick one by id.
+
+Reloads build a fresh snapshot and swap it in with a single assignment. A
+request holds the `BuiltWorkflow` it started with, so in-flight requests finish
+on the old version while new ones get the new one.
+
+Settings (env):
+    WORKFLOWS_DIR               definitions directory (default ./workflows)
+    DEFAULT_WORKFLOW_ID         used when a request names none (default "milieu")
+    WORKFLOW_RELOAD_INTERVAL    seconds between change checks, 0 disables (default 2)
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from agents import Agent, AgentOutputSchema, ModelSettings, RunConfig
+from pydantic import BaseModel, create_model
+
+from agent_workflow import TOOLS, instantiate_guardrail_config, pii_only_config, warm_up_clients
+
+
+WORKFLOWS_DIR = os.getenv(
+    "WORKFLOWS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows")
+)
+DEFAULT_WORKFLOW_ID = os.getenv("DEFAULT_WORKFLOW_ID", "milieu")
+WORKFLOW_RELOAD_INTERVAL = float(os.getenv("WORKFLOW_RELOAD_INTERVAL", "2"))
+
+
+class WorkflowNotFound(KeyError):
+    pass
+
+
+# ----------------------------
+# Definition schema
+# ----------------------------
+class AgentSpec(BaseModel):
+    name: str
+    model: str
+    instructions: Optional[str] = None
+    # Path relative to the definition file, for long prompts
+    instructions_file: Optional[str] = None
+    model_settings: dict[str, Any] = {}
+    tools: list[str] = []
+    # {"field": "str" | "int" | "float" | "bool"} -> structured output
+    output_schema: Optional[dict[str, str]] = None
+
+
+class Route(BaseModel):
+    agent: str
+    # When set, the reply is fixed text gated on approval_request() instead of the agent output
+    approval_message: Optional[str] = None
+    approved_reply: Optional[str] = None
+    rejected_reply: Optional[str] = None
+
+
+class Routing(BaseModel):
+    classifier: str
+    field: str = "classification"
+    routes: dict[str, Route] = {}
+
+
+class WorkflowDefinition(BaseModel):
+    id: str
+    trace_name: str
+    trace_workflow_id: str
+    guardrails: dict[str, Any] = {"guardrails": []}
+    agents: dict[str, AgentSpec]
+    routing: Routing
+
+
+# ----------------------------
+# Built workflows
+# ----------------------------
+@dataclass(frozen=True)
+class BuiltWorkflow:
+    id: str
+    version: str
+    definition: WorkflowDefinition
+    agents: dict[str, Agent]
+    guardrails_config: dict[str, Any]
+    # Owned by this version, so swapping it out releases them
+    guardrails: Any
+    pii_guardrails: Any
+    run_config: RunConfig
+    loaded_at: float = field(default_factory=time.time)
+
+
+_FIELD_TYPES = {"str": str, "int": int, "float": float, "bool": bool}
+
+
+def _output_type(spec: AgentSpec):
+    if spec.output_schema is None:
+        return None
+    fields = {}
+    for name, type_name in spec.output_schema.items():
+        if type_name not in _FIELD_TYPES:
+            raise ValueError(f"Agent {spec.name!r}: unsupported output type {type_name!r}")
+        fields[name] = (_FIELD_TYPES[type_name], ...)
+    model_name = "".join(w.capitalize() for w in spec.name.split()) + "Schema"
+    return create_model(model_name, **fields)
+
+
+def _instructions(spec: AgentSpec, base_dir: str) -> str:
+    if spec.instructions_file:
+        with open(os.path.join(base_dir, spec.instructions_file), encoding="utf-8") as f:
+            return f.read().rstrip("\n")
+    return spec.instructions or ""
+
+
+def _source_files(definition: WorkflowDefinition, path: str) -> list[str]:
+    base_dir = os.path.dirname(path)
+    files = [path]
+    for spec in definition.agents.values():
+        if spec.instructions_file:
+            files.append(os.path.join(base_dir, spec.instructions_file))
+    return files
+
+
+def _referenced_files(path: str) -> list[str]:
+    """
+    The files a definition reads, as far as it parses; just `path` if it does not.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return _source_files(WorkflowDefinition.model_validate(json.load(f)), path)
+    except Exception:
+        return [path]
+
+
+def _fingerprint(files: list[str]) -> str:
+    h = hashlib.sha256()
+    for path in files:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def build_workflow(path: str) -> tuple[BuiltWorkflow, list[str]]:
+    """
+    Parse and build one definition file. Returns the workflow and the files it was built from.
+    """
+    with open(path, encoding="utf-8") as f:
+        definition = WorkflowDefinition.model_validate(json.load(f))
+    base_dir = os.path.dirname(path)
+
+    agents = {}
+    for key, spec in definition.agents.items():
+        unknown = [t for t in spec.tools if t not in TOOLS]
+        if unknown:
+            raise ValueError(f"Agent {spec.name!r}: unknown tools {unknown}")
+        output_type = _output_type(spec)
+        agents[key] = Agent(
+            name=spec.name,
+            instructions=_instructions(spec, base_dir),
+            model=spec.model,
+            # Built once here; the Runner reuses an AgentOutputSchema instead of
+            # building a new one on every run
+            output_type=AgentOutputSchema(output_type) if output_type is not None else None,
+            tools=[TOOLS[t] for t in spec.tools],
+            model_settings=ModelSettings(**spec.model_settings),
+        )
+
+    routing = definition.routing
+    for name in [routing.classifier, *(r.agent for r in routing.routes.values())]:
+        if name not in agents:
+            raise ValueError(f"Workflow {definition.id!r}: routing refers to unknown agent {name!r}")
+
+    pii_config = pii_only_config(definition.guardrails)
+    files = _source_files(definition, path)
+    built = BuiltWorkflow(
+        id=definition.id,
+        version=_fingerprint(files),
+        definition=definition,
+        agents=agents,
+        guardrails_config=definition.guardrails,
+        guardrails=instantiate_guardrail_config(definition.guardrails),
+        pii_guardrails=instantiate_guardrail_config(pii_config) if pii_config else None,
+        run_config=RunConfig(
+            trace_metadata={
+                "__trace_source__": "agent-builder",
+                "workflow_id": definition.trace_workflow_id,
+            }
+        ),
+    )
+    return built, files
+
+
+# ----------------------------
+# Registry
+# ----------------------------
+class WorkflowRegistry:
+    def __init__(self, directory: str = WORKFLOWS_DIR, default_id: str = DEFAULT_WORKFLOW_ID):
+        self.directory = directory
+        self.default_id = default_id
+        # Replaced wholesale on reload, never mutated in place
+        self._workflows: dict[str, BuiltWorkflow] = {}
+        self._mtimes: dict[str, dict[str, float]] = {}  # definition path -> {source file: mtime}
+        self._paths: dict[str, str] = {}  # definition path -> workflow id
+
+    def get(self, workflow_id: Optional[str] = None) -> BuiltWorkflow:
+        workflows = self._workflows
+        wid = workflow_id or self.default_id
+        if wid not in workflows:
+            raise WorkflowNotFound(wid)
+        return workflows[wid]
+
+    def list(self) -> list[dict[str, Any]]:
+        return [
+            {"id": wf.id, "version": wf.version, "loaded_at": wf.loaded_at}
+            for wf in self._workflows.values()
+        ]
+
+    def _definition_paths(self) -> list[str]:
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        )
+
+    @staticmethod
+    def _stat(files) -> dict[str, float]:
+        # -1 marks a missing file (e.g. a prompt file not written yet)
+        stats = {}
+        for p in files:
+            try:
+                stats[p] = os.path.getmtime(p)
+            except OSError:
+                stats[p] = -1.0
+        return stats
+
+    def _changed(self, path: str) -> bool:
+        known = self._mtimes.get(path)
+        if known is None:
+            return True
+        return self._stat(known) != known
+
+    def load(self, force: bool = False) -> list[str]:
+        """
+        Build new/changed definitions and swap them in. Returns the ids that changed.
+
+        A definition that fails to build keeps its previous version (if any) and is
+        reported once per edit. On a forced (startup) load bad files are skipped
+        too; only a missing default workflow is an error. A rebuild whose content
+        fingerprint matches the running version (a touch, or an edit undone) is
+        not swapped in.
+        """
+        paths = self._definition_paths()
+        workflows = dict(self._workflows)
+        mtimes = dict(self._mtimes)
+        owners = dict(self._paths)
+        changed = []
+        errors = {}
+
+        for path in paths:
+            if not force and not self._changed(path):
+                continue
+            try:
+                built, files = build_workflow(path)
+                stats = self._stat(files)
+                if _fingerprint(files) != built.version:
+                    # Edited while building; build it again on the next poll
+                    stats[path] = -1.0
+            except Exception as e:
+                errors[path] = e
+                print(f"ERROR loading workflow {path}:", e)
+                traceback.print_exc()
+                # Remember what we saw so the error is not repeated on every poll,
+                # including prompt files the definition refers to but that do not exist yet
+                mtimes[path] = self._stat({*mtimes.get(path, {}), *_referenced_files(path)})
+                continue
+
+            mtimes[path] = stats
+            previous_id = owners.get(path)
+            owners[path] = built.id
+            current = workflows.get(built.id)
+            if previous_id == built.id and current is not None and current.version == built.version:
+                continue
+            if previous_id is not None and previous_id != built.id:
+                # The file's "id" changed; stop serving the old one
+                workflows.pop(previous_id, None)
+                changed.append(f"{previous_id} (removed)")
+            workflows[built.id] = built
+            changed.append(built.id)
+
+        # Definitions whose file was removed
+        for path in list(mtimes):
+            if path not in paths:
+                mtimes.pop(path)
+                wid = owners.pop(path, None)
+                if wid is not None:
+                    workflows.pop(wid, None)
+                    changed.append(f"{wid} (removed)")
+
+        if force and self.default_id not in workflows:
+            detail = "; ".join(f"{os.path.basename(p)}: {e}" for p, e in errors.items())
+            raise WorkflowNotFound(f"{self.default_id} ({detail})" if detail else self.default_id)
+
+        self._mtimes = mtimes
+        self._paths = owners
+        if changed:
+            self._workflows = workflows
+        return changed
+
+    async def watch(self, interval: float = WORKFLOW_RELOAD_INTERVAL):
+        """
+        Poll the definitions directory and hot-swap changed workflows.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = await asyncio.to_thread(self.load)
+            except Exception as e:
+                print("ERROR scanning workflows:", e)
+                continue
+            if changed:
+                print(f"Workflows reloaded: {', '.join(changed)}")
+
+
+registry = WorkflowRegistry()
+
+
+def warm_up() -> dict[str, float]:
+    """
+    Build every workflow definition and warm the clients they use. Returns timings in ms.
+    """
+    t0 = time.perf_counter()
+    registry.load(force=True)
+    t1 = time.perf_counter()
+    warm_up_clients([registry.get(w["id"]) for w in registry.list()])
+    return {"workflows": (t1 - t0) * 1000, "clients": (time.perf_counter() - t1) * 1000}